@@ -1,8 +1,44 @@
-from .version import PrintVersion as _printversion
-_printversion()
-
-from .core import init, print, HybridClient, CPUClient, GPUClient
-from .temp import TempCPUWorker as FullWATClient
-from .recycler import dump, load
 from .version import VERSION as __version__
 from .errors import *
+
+# Public names and the submodules defining them. Submodules (and their dependencies, e.g. `requests` and `numpy`)
+# are only imported when one of their names is first used, so `import crawlingathome` stays cheap and silent.
+_LAZY = {
+    "init": ("core", "init"),
+    "print": ("core", "print"),
+    "HybridClient": ("core", "HybridClient"),
+    "CPUClient": ("core", "CPUClient"),
+    "GPUClient": ("core", "GPUClient"),
+    "FullWATClient": ("temp", "TempCPUWorker"),
+    "AsyncHybridClient": ("aio", "AsyncHybridClient"),
+    "AsyncCPUClient": ("aio", "AsyncCPUClient"),
+    "AsyncGPUClient": ("aio", "AsyncGPUClient"),
+    "dump": ("recycler", "dump"),
+    "load": ("recycler", "load"),
+    "dumps": ("recycler", "dumps"),
+    "loads": ("recycler", "loads"),
+    "supervise": ("supervisor", "supervise"),
+    "Supervisor": ("supervisor", "Supervisor"),
+}
+
+
+def __getattr__(name):
+    from importlib import import_module
+
+    if name in _LAZY:
+        module, attr = _LAZY[name]
+        value = getattr(import_module("." + module, __name__), attr)
+    else:
+        try:
+            value = import_module("." + name, __name__)
+        except ModuleNotFoundError as e:
+            if e.name != f"{__name__}.{name}":
+                raise
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
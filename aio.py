@@ -0,0 +1,357 @@
+# asyncio counterparts of the clients in `core.py`, for driving many workers from a single event loop.
+# Requires the optional `aiohttp` dependency.
+
+from typing import Optional, Union
+from time import monotonic
+import asyncio
+import json
+import os
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .core import print, _handle_exceptions, _recordRequest
+from .download import GunzipStream, CHUNK_SIZE, RETRIES, MEMBERS_SUFFIX, _record, _save_members, _remove
+from .retry import select_policy
+from .job import as_id
+from .errors import *
+from . import tarstream, transport, metrics
+
+# The connection pool shared by every async client that isn't given its own session.
+_shared_session = None
+
+# (connect, read) timeouts of shard streams in seconds. There is no overall limit, so a large shard may take as
+# long as it needs while a stalled connection is resumed.
+STREAM_TIMEOUT = (30, 60)
+
+
+# Returns the shared `aiohttp.ClientSession`, creating it on first use inside the running event loop.
+def shared_session(limit: int = 100, limit_per_host: int = 0) -> "aiohttp.ClientSession":
+    global _shared_session
+
+    if aiohttp is None:
+        raise ImportError("[crawling@home] the async clients require `aiohttp` (pip install aiohttp)")
+
+    if _shared_session is None or _shared_session.closed:
+        connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host)
+        _shared_session = aiohttp.ClientSession(connector=connector)
+    return _shared_session
+
+
+# Closes the shared connection pool. Call once all async clients are finished.
+async def close_shared_session() -> None:
+    global _shared_session
+
+    if _shared_session is not None:
+        await _shared_session.close()
+        _shared_session = None
+
+
+class _Response:
+    def __init__(self, status_code: int, text: str) -> None:
+        self.status_code = status_code
+        self.text = text
+
+
+# Async `_safe_request`: retries follow `policy` (see `retry.select_policy`) without blocking the event loop.
+# Requests time out after `transport.DEFAULT_TIMEOUT` (connect, read) seconds unless `timeout` is given.
+async def _safe_request(s, method: str, url: str, policy=None, **kwargs) -> _Response:
+    state = select_policy(policy, url).start()
+    sink = metrics.active
+    if aiohttp is not None and "timeout" not in kwargs:
+        connect, read = transport.DEFAULT_TIMEOUT
+        kwargs["timeout"] = aiohttp.ClientTimeout(total=None, sock_connect=connect, sock_read=read)
+
+    while True:
+        try:
+            async with s.request(method, url, **kwargs) as r:
+                response = _Response(r.status, await r.text())
+        except Exception as e:
+            delay = state.onError()
+            if sink is not None:
+                _recordRequest(sink, url, state, "error", delay)
+            if delay is None:
+                print(f"giving up request after {e} error")
+                raise
+            print(f"retrying request after {e} error in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+            continue
+
+        delay = state.onStatus(response.status_code)
+        if sink is not None:
+            _recordRequest(sink, url, state, response.status_code, delay)
+        if delay is None:
+            return response
+        print(f"retrying request after status {response.status_code} in {delay:.1f}s...")
+        await asyncio.sleep(delay)
+
+
+# Shared implementation of the async clients. Subclasses set `TYPE` and override what differs per worker type.
+class _AsyncClient:
+    TYPE = None
+
+    def __init__(self, url, nickname, session=None, retry=None) -> None:
+        if url[-1] != "/":
+            url += "/"
+
+        self.s = session or shared_session()
+        self.retry = retry
+        self.url = url
+        self.type = self.TYPE
+        self.nickname = nickname
+
+    # Registers the worker with the server. Called by `init()`.
+    async def connect(self) -> None:
+        print("connecting to crawling@home server...")
+        payload = {"nickname": self.nickname, "type": self.TYPE}
+        r = await _safe_request(self.s, "GET", self.url + "api/new", params=payload, policy=self.retry)
+
+        exc = _handle_exceptions(r.status_code, r.text)
+        if exc:
+            raise exc
+
+        print("connected to crawling@home server")
+        data = _json(r)
+        self.token = data["token"]
+        self.display_name = data["display_name"]
+        self.upload_address = data["upload_address"]
+
+        print(f"worker name: {self.display_name}")
+
+    async def _request(self, method: str, endpoint: str, **kwargs) -> _Response:
+        r = await _safe_request(self.s, method, self.url + endpoint, policy=self.retry, **kwargs)
+
+        exc = _handle_exceptions(r.status_code, r.text)
+        if exc:
+            await self.log("Crashed", crashed=True)
+            raise exc
+        return r
+
+    # Updates the upload server.
+    async def updateUploadServer(self) -> None:
+        r = await self._request("GET", "api/getUploadAddress", params={"type": self.TYPE})
+        self.upload_address = r.text
+
+        print("updated upload server address")
+
+    # Finds the amount of available jobs from the server, returning an integer.
+    async def jobCount(self) -> int:
+        r = await self._request("GET", "api/jobCount", params={"type": self.TYPE})
+        count = int(r.text)
+
+        print(f"jobs remaining: {count}")
+
+        return count
+
+    # Makes the node send a request to the server, asking for a new job.
+    async def newJob(self) -> None:
+        print("looking for new job...")
+
+        r = await self._request("POST", "api/newJob", json={"token": self.token, "type": self.TYPE})
+
+        data = _json(r)
+        self.shard = data["url"]
+        self.start_id = as_id(data["start_id"])
+        self.end_id = as_id(data["end_id"])
+        self.shard_piece = data["shard"]
+
+        print("recieved new job")
+
+    # Downloads the current job's shard to `path` + shard.wat, decompressing it as it arrives.
+    async def downloadShard(self, path="", chunk_size=None) -> None:
+        print("downloading shard...")
+        await self.log("Downloading shard", noprint=True)
+
+        await _stream_gunzip(self.s, self.shard, path + "shard.wat", chunk_size)
+
+        await self.log("Downloaded shard", noprint=True)
+        print("finished downloading shard")
+
+    # Marks the current job as done.
+    async def completeJob(self, total_scraped : int) -> None:
+        await self._request("POST", "api/markAsDone", json={"token": self.token, "count": total_scraped, "type": self.TYPE})
+
+        print("marked job as done")
+
+    # Logs the string progress into the server.
+    async def log(self, progress : str, crashed=False, noprint=False) -> None:
+        data = {"token": self.token, "progress": progress, "type": self.TYPE}
+
+        r = await _safe_request(self.s, "POST", self.url + "api/updateProgress", json=data, policy=self.retry)
+
+        exc = _handle_exceptions(r.status_code, r.text)
+        if exc and not crashed:
+            await self.log("Crashed", crashed=True)
+            raise exc
+
+        if not crashed and not noprint:
+            print(f"logged new progress data: {progress}")
+
+    # Client wrapper for `recycler.dump`.
+    def dump(self) -> dict:
+        from .recycler import dump as _dump
+        return _dump(self)
+
+    # Recreates the client with the server, giving the client a new auth token, upload server and display name.
+    async def recreate(self) -> None:
+        print("recreating client instance...")
+        await self.connect()
+
+    # Returns True if the worker is still alive, otherwise returns False.
+    async def isAlive(self) -> bool:
+        r = await self._request("POST", "api/validateWorker", json={"token": self.token, "type": self.TYPE})
+        return ("True" in r.text)
+
+    # Removes the node instance from the server, ending all current jobs.
+    async def bye(self) -> None:
+        await _safe_request(self.s, "POST", self.url + "api/bye", json={"token": self.token, "type": self.TYPE}, policy=self.retry)
+        print("closed worker")
+
+
+# The async 'hybrid' client instance.
+class AsyncHybridClient(_AsyncClient):
+    TYPE = "HYBRID"
+
+
+# The async CPU client instance.
+class AsyncCPUClient(_AsyncClient):
+    TYPE = "CPU"
+
+    # Uploads the image download URL for the GPU workers to use, marking the CPU job complete.
+    async def completeJob(self, image_download_url : str) -> None:
+        await self._request("POST", "api/markAsDone", json={
+            "token": self.token,
+            "url": image_download_url,
+            "type": self.TYPE
+        })
+
+        print("marked job as done")
+
+
+# The async GPU client instance.
+class AsyncGPUClient(_AsyncClient):
+    TYPE = "GPU"
+
+    # Flags a GPU job's URL as invalid to the server.
+    async def invalidURL(self) -> None:
+        r = await _safe_request(self.s, "POST", self.url + "api/gpuInvalidDownload", json={"token": self.token, "type": self.TYPE}, policy=self.retry)
+
+        if r.status_code != 200:
+            print("something went wrong when flagging a URL as invalid - not raising error.")
+        else:
+            print("successfully flagged url as invalid")
+        raise InvalidURLError('[crawling@home] Invalid URL')
+
+    # Downloads the CPU worker's processed images into the `path` directory, extracting them while they transfer
+    # (in the default executor, over the process's shared `requests` pool). The names of the extracted files are
+    # kept in `members`.
+    async def downloadShard(self, path="", chunk_size=None) -> None:
+        print("downloading shard...")
+        await self.log("Downloading shard", noprint=True)
+
+        if self.shard.startswith(('http', 'file://')):
+            self.members = await _run_blocking(tarstream.fetch_extract, transport.shared_session(), self.shard, path)
+        elif self.shard.startswith('rsync'):
+            uid = self.shard.split('rsync', 1)[-1].strip()
+            for _ in range(5):
+                resp, members = await _run_blocking(
+                    tarstream.rsync_extract, f"{tarstream.RSYNC_SOURCE}{uid}.tar.gz", f"{path}{uid}.tar.gz", path
+                )
+                if resp == tarstream.RSYNC_NOT_FOUND:
+                    print('[crawling@home] rsync job not found')
+                    await self.invalidURL()
+                if resp == 0:
+                    self.members = members
+                    break
+            else:
+                raise IncompleteArchiveError(f"[crawling@home] unable to download {uid}.tar.gz (rsync exit code {resp})")
+        else:
+            await self.invalidURL()
+
+        await self.log("Downloaded shard", noprint=True)
+        print("finished downloading shard")
+
+
+def _json(r: _Response) -> dict:
+    return json.loads(r.text)
+
+
+async def _run_blocking(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+# Async `download.stream_gunzip`: chunks are inflated and written to disk in the default executor,
+# so neither decompression nor file I/O blocks the event loop. A dropped or stalled stream (see `STREAM_TIMEOUT`)
+# is resumed from the last received byte with a range request, or restarted when the server ignores ranges.
+async def _stream_gunzip(s, url: str, out_path: str, chunk_size: int = None, retries: int = None) -> int:
+    chunk_size = chunk_size or CHUNK_SIZE
+    retries = RETRIES if retries is None else retries
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=STREAM_TIMEOUT[0], sock_read=STREAM_TIMEOUT[1])
+    gz = GunzipStream()
+    attempt = 0
+    started = monotonic()
+    await _run_blocking(_remove, out_path + MEMBERS_SUFFIX)
+    f = await _run_blocking(open, out_path, "wb")
+
+    def restart() -> None:
+        f.seek(0)
+        f.truncate()
+
+    try:
+        while True:
+            headers = {"Range": f"bytes={gz.bytes_in}-"} if gz.bytes_in else None
+            try:
+                async with s.get(url, headers=headers, timeout=timeout) as r:
+                    r.raise_for_status()
+                    if gz.bytes_in and r.status != 206:
+                        # Ranges unsupported: start over with a clean decompressor and output file.
+                        gz = GunzipStream()
+                        await _run_blocking(restart)
+                    async for chunk in r.content.iter_chunked(chunk_size):
+                        await _run_blocking(lambda c: f.write(gz.feed(c)), chunk)
+                await _run_blocking(lambda: f.write(gz.flush()))
+                break
+            except Exception as e:
+                if attempt >= retries or _is_client_error(e):
+                    raise
+                attempt += 1
+                print(f"shard stream interrupted after {gz.bytes_in} bytes ({e}), resuming...")
+                await asyncio.sleep(min(2 ** attempt, 30))
+    except BaseException:
+        f.close()
+        os.remove(out_path)
+        raise
+
+    await _run_blocking(f.close)
+    await _run_blocking(_save_members, out_path, gz)
+    _record("wat", gz.bytes_in, started, gz)
+    return gz.bytes_out
+
+
+# 4xx responses (bar 408/429) won't fix themselves, so they are not worth retrying.
+def _is_client_error(e: Exception) -> bool:
+    if aiohttp is None or not isinstance(e, aiohttp.ClientResponseError):
+        return False
+    status = getattr(e, "status", None)
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+
+# Creates, connects and returns a new async client instance.
+async def init(url="http://crawlingathome.duckdns.org/", nickname="anonymous", type="Hybrid",
+               session=None, retry=None) -> Optional[Union[AsyncHybridClient, AsyncCPUClient, AsyncGPUClient]]:
+    if isinstance(type, str):
+        type = type.lower()[0]
+
+    if type == "h" or type == AsyncHybridClient:
+        c = AsyncHybridClient(url, nickname, session, retry)
+    elif type == "c" or type == AsyncCPUClient:
+        c = AsyncCPUClient(url, nickname, session, retry)
+    elif type == "g" or type == AsyncGPUClient:
+        c = AsyncGPUClient(url, nickname, session, retry)
+    else:
+        raise ValueError(f"[crawling@home] invalid worker `{type}`")
+
+    await c.connect()
+    return c
@@ -0,0 +1,219 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from bisect import bisect_right
+from threading import Lock
+from time import time
+import tarfile
+import struct
+import json
+import zlib
+import csv
+import io
+import os
+
+# The metadata CSV written at the end of every archive, read by `loader.ImageLoader` from extracted shards.
+METADATA_NAME = "images.csv"
+METADATA_COLUMNS = ("SAMPLE_ID", "URL", "TEXT")
+
+# Prefix of the PAX header records carrying each image's metadata columns (e.g. `CAH.TEXT`), so readers streaming
+# the archive get an image's metadata along with it rather than from the CSV at the end.
+PAX_PREFIX = "CAH."
+
+# Uncompressed bytes compressed per block (and task) in the pool.
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+# The sidecar index written next to an archive (`<archive>.idx`).
+INDEX_SUFFIX = ".idx"
+
+# Leading bytes identifying image formats, for naming members whose URL has no usable extension.
+_MAGIC = ((b"\xff\xd8\xff", ".jpg"), (b"\x89PNG", ".png"), (b"GIF8", ".gif"), (b"BM", ".bmp"))
+
+# An empty, final deflate block, ending the stream after the flushed blocks.
+_END = b"\x03\x00"
+
+
+def _deflate(data: bytes, level: int) -> bytes:
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return c.compress(data) + c.flush(zlib.Z_FULL_FLUSH)
+
+
+def _extension(data: bytes) -> str:
+    for magic, ext in _MAGIC:
+        if data.startswith(magic):
+            return ext
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    return ".jpg"
+
+
+# Writes a job's `.tar.gz` while images are added, compressing blocks of the tar stream in parallel across
+# `workers` threads (zlib releases the GIL) so the archive is complete as soon as the last image is added.
+# * Blocks are deflated independently and flushed to byte boundaries, then joined into a single gzip member
+#   (like `pigz -i`), so any gzip reader, including `tarfile`'s streaming mode, reads it as usual.
+# * `add()`/`addImage()` may be called from several threads. Compressed blocks are written in order, with at
+#   most `2 * workers` blocks in flight.
+# * The archive is written to `<path>.part` and renamed to `path` by `close()`, along with a sidecar index
+#   (`<path>.idx`, JSON) of every member's offset and size and every block's offsets (see `read_member()`).
+# Use as a context manager: an exception discards the partial archive.
+class ArchiveWriter:
+    def __init__(self, path: str, level: int = 6, workers: int = None, block_size: int = DEFAULT_BLOCK_SIZE,
+                 index: bool = True) -> None:
+        self.path = path
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self.block_size = block_size
+        self.index = index
+
+        self.members = []   # [name, data offset, size] in the uncompressed tar stream
+        self.blocks = []    # [uncompressed offset, compressed offset] of every block
+        self.rows = []
+        self.closed = False
+
+        self._lock = Lock()
+        self._pending = bytearray()
+        self._offset = 0        # uncompressed bytes handed to the pool
+        self._written = 0       # compressed bytes written to the file
+        self._crc = 0
+        self._inflight = deque()
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="cah-archive")
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._f = open(path + ".part", "wb")
+        self._f.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", int(time())) + b"\x00\xff")
+        self._header = self._f.tell()
+
+    def __enter__(self) -> "ArchiveWriter":
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    # Appends a file named `name` holding `data` to the archive, with `pax` ({keyword: value}) as PAX header records.
+    def add(self, name: str, data: bytes, mtime: float = None, pax: dict = None) -> None:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(mtime if mtime is not None else time())
+        info.mode = 0o644
+        if pax:
+            info.pax_headers = pax
+        header = info.tobuf(tarfile.PAX_FORMAT if pax else tarfile.GNU_FORMAT, "utf-8", "surrogateescape")
+
+        with self._lock:
+            if self.closed:
+                raise ValueError("[crawling@home] the archive is already closed")
+            self.members.append([name, self._offset + len(self._pending) + len(header), len(data)])
+            self._pending += header
+            self._pending += data
+            self._pending += b"\0" * (-len(data) % tarfile.BLOCKSIZE)
+            while len(self._pending) >= self.block_size:
+                self._submit(self.block_size)
+
+    # Appends a fetched image (anything with `url`, `alt`, `id` and `data`, e.g. a `fetch.FetchedImage`) as
+    # `<id>.<ext>`, with its metadata in the member's PAX header and its row added to the metadata CSV.
+    # Returns the member's name.
+    def addImage(self, image) -> str:
+        row = (int(image.id), image.url or "", image.alt or "")
+        name = f"{row[0]}{_extension(image.data)}"
+        self.add(name, image.data, pax={PAX_PREFIX + column: str(value) for column, value in zip(METADATA_COLUMNS, row)})
+        with self._lock:
+            self.rows.append(row)
+        return name
+
+    # Adds every image of `images`, returning how many were added.
+    def addImages(self, images) -> int:
+        n = 0
+        for image in images:
+            self.addImage(image)
+            n += 1
+        return n
+
+    # Compresses the first `size` pending bytes in the pool, writing out blocks that are done.
+    def _submit(self, size: int) -> None:
+        block = bytes(self._pending[:size])
+        del self._pending[:size]
+        self._crc = zlib.crc32(block, self._crc)
+        self._inflight.append((self._offset, self._pool.submit(_deflate, block, self.level)))
+        self._offset += len(block)
+        self._drain(2 * self.workers)
+
+    # Writes finished blocks in order, waiting until at most `keep` are in flight.
+    def _drain(self, keep: int) -> None:
+        while self._inflight and (len(self._inflight) > keep or self._inflight[0][1].done()):
+            offset, future = self._inflight.popleft()
+            data = future.result()
+            self.blocks.append([offset, self._header + self._written])
+            self._f.write(data)
+            self._written += len(data)
+
+    # Writes the metadata CSV and the end of the archive, returning the path of the finished `.tar.gz`.
+    def close(self) -> str:
+        if self.closed:
+            return self.path
+
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(METADATA_COLUMNS)
+        writer.writerows(self.rows)
+        self.add(METADATA_NAME, out.getvalue().encode())
+
+        with self._lock:
+            self.closed = True
+            self._pending += b"\0" * (2 * tarfile.BLOCKSIZE)
+            self._pending += b"\0" * (-(self._offset + len(self._pending)) % tarfile.RECORDSIZE)
+            while self._pending:
+                self._submit(min(len(self._pending), self.block_size))
+            self._drain(0)
+            self._pool.shutdown()
+
+            self._f.write(_END + struct.pack("<II", self._crc, self._offset & 0xFFFFFFFF))
+            self._f.close()
+
+        if self.index:
+            with open(self.path + INDEX_SUFFIX, "w") as f:
+                json.dump({"version": 1, "size": self._offset, "blocks": self.blocks, "members": self.members}, f)
+        os.replace(self.path + ".part", self.path)
+        return self.path
+
+    # Discards the partial archive.
+    def abort(self) -> None:
+        with self._lock:
+            self.closed = True
+            self._pool.shutdown(cancel_futures=True)
+            self._f.close()
+        if os.path.exists(self.path + ".part"):
+            os.remove(self.path + ".part")
+
+
+# Reads the member `name` of an archive written by `ArchiveWriter` without decompressing what precedes it,
+# using its sidecar index (`index` defaults to `<path>.idx`).
+def read_member(path: str, name: str, index: dict = None) -> bytes:
+    if index is None:
+        with open(path + INDEX_SUFFIX) as f:
+            index = json.load(f)
+
+    for member, offset, size in index["members"]:
+        if member == name:
+            break
+    else:
+        raise KeyError(f"[crawling@home] {name!r} is not in {path}")
+
+    # the last block starting at or before the member's data
+    blocks = index["blocks"]
+    i = bisect_right([block[0] for block in blocks], offset) - 1
+    skip = offset - blocks[i][0]
+
+    d = zlib.decompressobj(-zlib.MAX_WBITS)
+    out = bytearray()
+    with open(path, "rb") as f:
+        f.seek(blocks[i][1])
+        while len(out) < skip + size:
+            chunk = f.read(1 << 16)
+            if not chunk:
+                raise EOFError(f"[crawling@home] {path} ends inside {name!r}")
+            out += d.decompress(chunk, skip + size - len(out))
+            while d.unconsumed_tail and len(out) < skip + size:
+                out += d.decompress(d.unconsumed_tail, skip + size - len(out))
+    return bytes(out[skip:skip + size])
@@ -0,0 +1,76 @@
+# Measures how long `import crawlingathome` takes in a fresh interpreter, and checks that it stays free of
+# side effects: nothing printed, no logging configured and no heavy dependencies imported.
+# Exits with status 1 if a check fails or the median import time exceeds `--budget` milliseconds.
+#
+#   python benchmarks/import_time.py [--runs 20] [--budget 50]
+
+from statistics import median
+from ast import literal_eval
+import subprocess
+import argparse
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = os.path.basename(ROOT)
+
+# Modules that must not be imported by `import crawlingathome` alone.
+HEAVY = ("numpy", "requests", "urllib3", "aiohttp", "tarfile", "gzip", "PIL", "pyarrow", "orjson")
+
+PROBE = f"""
+import sys, logging
+import {PACKAGE}
+sys.stderr.write(repr((
+    [m for m in {HEAVY!r} if m in sys.modules],
+    len(logging.getLogger().handlers),
+)) + "\\n")
+"""
+
+
+# Imports the package in a fresh interpreter, returning (import time in ms, heavy modules, root log handlers, stdout).
+def _probe() -> tuple:
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE],
+        cwd=os.path.dirname(ROOT), capture_output=True, text=True, check=True
+    )
+    lines = p.stderr.strip().splitlines()
+    heavy, handlers = literal_eval(lines[-1])
+
+    # `-X importtime` lines look like "import time: self [us] | cumulative | imported package"
+    cumulative = 0
+    for line in lines[:-1]:
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == PACKAGE:
+            cumulative = int(parts[1])
+    return cumulative / 1000, heavy, handlers, p.stdout
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--budget", type=float, default=50.0, help="maximum median import time in ms")
+    args = parser.parse_args()
+
+    results = [_probe() for _ in range(args.runs)]
+    times = sorted(r[0] for r in results)
+    _, heavy, handlers, stdout = results[-1]
+
+    print(f"import {PACKAGE}: median {median(times):.2f} ms, min {times[0]:.2f} ms, max {times[-1]:.2f} ms ({args.runs} runs)")
+
+    failed = []
+    if heavy:
+        failed.append(f"imports {', '.join(heavy)}")
+    if handlers:
+        failed.append("configures logging")
+    if stdout:
+        failed.append(f"prints {stdout!r}")
+    if median(times) > args.budget:
+        failed.append(f"exceeds the {args.budget:.0f} ms budget")
+
+    for reason in failed:
+        print(f"FAIL: import {PACKAGE} {reason}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
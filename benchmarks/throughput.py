@@ -0,0 +1,143 @@
+# End-to-end throughput benchmark against the in-process `MockTracker`: runs 1..N concurrent workers of a
+# client type through their full job loop (lease, download, log, complete) and reports jobs/sec, download
+# bytes/sec and p50/p99 latency per tracker endpoint for each concurrency level.
+#
+#   python benchmarks/throughput.py [--type CPU] [--workers 8] [--duration 10] [--latency 0.005] [--error-rate 0.01]
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import defaultdict
+from threading import Event, Lock
+from time import monotonic
+from importlib import import_module
+import argparse
+import tempfile
+import logging
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(ROOT))
+cah = import_module(os.path.basename(ROOT))
+mock = import_module(os.path.basename(ROOT) + ".mock")
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.latency = defaultdict(list)
+        self.jobs = 0
+        self.bytes = 0
+        self.errors = 0
+
+    # A `requests` response hook recording every request's latency under its endpoint.
+    def hook(self, tracker_url: str):
+        def record(r, *args, **kwargs):
+            endpoint = r.url[len(tracker_url):].split("?", 1)[0]
+            if endpoint.startswith("files/"):
+                endpoint = f"files/*.{endpoint.rsplit('.', 2)[-2]}.gz ({r.request.method})"
+                if r.request.method == "GET":
+                    with self.lock:
+                        self.bytes += int(r.headers.get("Content-Length", 0))
+            with self.lock:
+                self.latency[endpoint].append(r.elapsed.total_seconds())
+        return record
+
+
+def _percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+# Runs one worker's job loop until `stop` is set or the tracker runs out of jobs.
+def _worker(kind: str, tracker, stats: Stats, stop: Event) -> None:
+    with tempfile.TemporaryDirectory(prefix="cah-bench-") as path:
+        _loop(kind, tracker, stats, stop, path + "/")
+
+
+def _loop(kind: str, tracker, stats: Stats, stop: Event, path: str) -> None:
+    hook = stats.hook(tracker.url)
+
+    if kind == "FULLWAT":
+        client = cah.FullWATClient(tracker.url, "bench")
+        client.s.hooks["response"].append(hook)
+        client._c.s.hooks["response"].append(hook)
+    else:
+        client = cah.init(tracker.url, "bench", type=kind)
+        client.s.hooks["response"].append(hook)
+
+    try:
+        while not stop.is_set():
+            try:
+                client.newJob()
+                if kind == "FULLWAT":
+                    client.downloadWat(path)
+                    client.completeJob({})
+                    n = 2
+                else:
+                    client.downloadShard(path)
+                    client.log("Processing")
+                    if kind == "CPU":
+                        client.completeJob(f"{tracker.url}files/images-{stats.jobs}.tar.gz")
+                    else:
+                        client.completeJob(1)
+                    n = 1
+            except cah.errors.ZeroJobError:
+                break
+            except Exception:
+                with stats.lock:
+                    stats.errors += 1
+                continue
+            with stats.lock:
+                stats.jobs += n
+    finally:
+        if kind == "FULLWAT":
+            client._c.bye()
+        else:
+            client.bye()
+
+
+def run(kind: str, workers: int, duration: float, **tracker_kwargs) -> Stats:
+    stats = Stats()
+    stop = Event()
+    with mock.MockTracker(**tracker_kwargs) as tracker:
+        started = monotonic()
+        with ThreadPoolExecutor(workers) as pool:
+            futures = [pool.submit(_worker, kind, tracker, stats, stop) for _ in range(workers)]
+            wait(futures, timeout=duration)
+            stop.set()
+            for future in futures:
+                future.result()
+        stats.elapsed = monotonic() - started
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--type", default="CPU", choices=("HYBRID", "CPU", "GPU", "FULLWAT"))
+    parser.add_argument("--workers", type=int, default=8, help="benchmark 1, 2, 4, ... up to this many workers")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per concurrency level")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every tracker request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of tracker requests failing with 5xx")
+    parser.add_argument("--records", type=int, default=1000, help="records per synthetic WAT")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    levels = []
+    n = 1
+    while n < args.workers:
+        levels.append(n)
+        n *= 2
+    levels.append(args.workers)
+
+    for n in levels:
+        stats = run(args.type, n, args.duration, latency=args.latency, error_rate=args.error_rate, records=args.records)
+        print(f"{args.type} x{n}: {stats.jobs / stats.elapsed:.1f} jobs/s, "
+              f"{stats.bytes / stats.elapsed / 1e6:.1f} MB/s downloaded, {stats.errors} errors")
+        for endpoint, values in sorted(stats.latency.items()):
+            print(f"    {endpoint:24} n={len(values):<6} p50 {_percentile(values, 0.5) * 1000:7.2f} ms"
+                  f"   p99 {_percentile(values, 0.99) * 1000:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+from contextlib import contextmanager
+from threading import Lock
+import hashlib
+import fcntl
+import shutil
+import json
+import os
+
+from .download import fetch_shard, CHUNK_SIZE, MEMBERS_SUFFIX
+from . import metrics
+
+# Where the cache lives unless told otherwise, shared by every worker of the same user on the host.
+DEFAULT_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "crawlingathome", "shards")
+
+# Default size bound of the cache (50 GB).
+DEFAULT_MAX_SIZE = 50 * 10 ** 9
+
+# The Linux ioctl cloning a file's extents (a reflink) on copy-on-write filesystems such as Btrfs and XFS.
+_FICLONE = 0x40049409
+
+
+# A host-local cache of decompressed shards shared by every worker on the host.
+# Shards are stored once by the SHA-256 of their content (`objects/<digest>`), and shard URLs point at them
+# (`urls/<sha256 of url>.json`). Workers fetching the same URL take turns on a per-URL file lock, so the first
+# downloads it and the others wait and reuse it.
+# Shards are delivered into a worker's path as hardlinks, reflinks (on other filesystems that support them) or
+# copies, in that order, along with their member index (`objects/<digest>.members`, see `download.MEMBERS_SUFFIX`).
+# Once the cache grows past `max_size` bytes, the least recently used shards are removed.
+class ShardCache:
+    def __init__(self, path: str = DEFAULT_PATH, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self.path = path
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._lock = Lock()
+
+        for name in ("objects", "urls", "locks", "tmp"):
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+
+    # Writes the decompressed shard at `url` to `out_path`, downloading it (see `download.fetch_shard`) only if
+    # the cache doesn't hold it yet. Returns True on a cache hit.
+    def fetch(self, s, url: str, out_path: str, chunk_size: int = None, segments: int = 1) -> bool:
+        key = hashlib.sha256(url.encode()).hexdigest()
+
+        with self._locked(os.path.join(self.path, "locks", key + ".lock")):
+            entry = self._entry(key)
+            if entry is not None and self._deliver(entry["digest"], out_path):
+                self._count(True, entry["size"])
+                return True
+
+            digest, size = self._download(s, url, chunk_size, segments)
+            self._write(key, {"url": url, "digest": digest, "size": size})
+            self._deliver(digest, out_path)
+            self._count(False, size)
+
+        self.evict()
+        return False
+
+    def _entry(self, key: str) -> dict:
+        try:
+            with open(os.path.join(self.path, "urls", key + ".json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, key: str, entry: dict) -> None:
+        tmp = os.path.join(self.path, "tmp", f"{key}.{os.getpid()}.json")
+        with open(tmp, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, os.path.join(self.path, "urls", key + ".json"))
+
+    # Downloads `url` into the cache, returning the (digest, size) of its decompressed content.
+    def _download(self, s, url: str, chunk_size: int, segments: int) -> tuple:
+        tmp = os.path.join(self.path, "tmp", f"{os.getpid()}-{id(self)}.wat")
+        try:
+            fetch_shard(s, url, tmp, chunk_size, segments)
+
+            h = hashlib.sha256()
+            with open(tmp, "rb") as f:
+                for chunk in iter(lambda: f.read(chunk_size or CHUNK_SIZE), b""):
+                    h.update(chunk)
+            digest, size = h.hexdigest(), os.path.getsize(tmp)
+
+            obj = os.path.join(self.path, "objects", digest)
+            if os.path.exists(tmp + MEMBERS_SUFFIX):
+                os.replace(tmp + MEMBERS_SUFFIX, obj + MEMBERS_SUFFIX)
+            if os.path.exists(obj):
+                os.utime(obj)  # the same content under another URL
+            else:
+                os.replace(tmp, obj)
+        finally:
+            for name in (tmp, tmp + MEMBERS_SUFFIX):
+                if os.path.exists(name):
+                    os.remove(name)
+        return digest, size
+
+    # Delivers the object `digest` to `out_path`, returning False if it has been evicted.
+    def _deliver(self, digest: str, out_path: str) -> bool:
+        obj = os.path.join(self.path, "objects", digest)
+        for name in (out_path, out_path + MEMBERS_SUFFIX):
+            if os.path.exists(name):
+                os.remove(name)
+
+        try:
+            os.utime(obj)  # marks it as recently used
+            _place(obj, out_path)
+        except FileNotFoundError:
+            return False
+        try:
+            _place(obj + MEMBERS_SUFFIX, out_path + MEMBERS_SUFFIX)
+        except FileNotFoundError:
+            pass  # cached before member indexes were kept
+        return True
+
+    def _count(self, hit: bool, size: int) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.bytes_saved += size
+            else:
+                self.misses += 1
+        if metrics.active is not None:
+            metrics.active.inc("cah_cache_requests_total", 1, {"result": "hit" if hit else "miss"})
+
+    @contextmanager
+    def _locked(self, path: str, blocking: bool = True):
+        with open(path, "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # Removes the least recently used shards until the cache fits in `max_size`, returning the bytes freed.
+    # Workers still reading an evicted shard keep their hardlink; only the cache's copy goes.
+    def evict(self) -> int:
+        with self._locked(os.path.join(self.path, "locks", "evict.lock"), blocking=False) as locked:
+            if not locked:
+                return 0  # another worker is already evicting
+
+            objects = []
+            for entry in os.scandir(os.path.join(self.path, "objects")):
+                if entry.name.endswith(MEMBERS_SUFFIX):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                objects.append((st.st_mtime, st.st_size, entry.path))
+
+            total = sum(size for _, size, _ in objects)
+            freed = 0
+            for _, size, path in sorted(objects):
+                if total - freed <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                    freed += size
+                except FileNotFoundError:
+                    pass
+                if os.path.exists(path + MEMBERS_SUFFIX):
+                    os.remove(path + MEMBERS_SUFFIX)
+            return freed
+
+    # Returns the cache's hit/miss counts (for this process) and its current number of shards and size.
+    def stats(self) -> dict:
+        sizes = [entry.stat().st_size for entry in os.scandir(os.path.join(self.path, "objects"))
+                 if not entry.name.endswith(MEMBERS_SUFFIX)]
+        return {"hits": self.hits, "misses": self.misses, "bytes_saved": self.bytes_saved,
+                "shards": len(sizes), "size": sum(sizes)}
+
+
+# Hardlinks `src` to `dst`, or clones it where that isn't possible.
+def _place(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        _clone(src, dst)
+
+
+# Copies `src` to `dst` as a reflink where the filesystem supports it, or as a plain copy otherwise.
+def _clone(src: str, dst: str) -> None:
+    with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+        try:
+            fcntl.ioctl(f_out.fileno(), _FICLONE, f_in.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfileobj(f_in, f_out, CHUNK_SIZE)
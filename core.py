@@ -4,32 +4,81 @@
 # TheoCoombes/crawlingathome #
 ##############################
 
-from requests import session, Response
-from typing import Optional, Union
-from time import sleep
-import numpy as np
+from requests import Response
+from typing import Iterator, Optional, Union
+from collections import deque
+from time import sleep, monotonic
 import logging
-import tarfile
-import shutil
-import gzip
-import os
 
+from .download import fetch_shard
+from .wat import WatRecord, iter_records, iter_url_records
+from .job import Job
+from . import metrics, trace
+from .trace import traced
+from .prefetch import Prefetcher, unstage
+from .progress import ProgressLogger
+from .heartbeat import Heartbeat
+from .retry import select_policy
+from .transport import make_session, DEFAULT_POOL_SIZE, DEFAULT_TIMEOUT
 from .errors import *
 
-logging.basicConfig(format="[%(asctime)s crawling@home] %(message)s", datefmt="%H:%M", level=logging.INFO)
-
 _builtin_print = print
+_configured = False
 
+# Logging is only configured once there is something to log, so importing the package has no side effects.
 def print(message) -> None:
+    global _configured
+    if not _configured:
+        logging.basicConfig(format="[%(asctime)s crawling@home] %(message)s", datefmt="%H:%M", level=logging.INFO)
+        _configured = True
     logging.info(message)
 
-def _safe_request(function, *args, **kwargs) -> Response:
-    try:
-        return function(*args, **kwargs)
-    except Exception as e:
-        print(f"retrying request after {e} error...")
-        sleep(60)
-        return _safe_request(function, *args, **kwargs)
+
+_greeted = False
+
+def _printVersion() -> None:
+    global _greeted
+    if not _greeted:
+        from .version import PrintVersion
+        PrintVersion()
+        _greeted = True
+
+# Makes a request, retrying connection errors and retryable statuses according to `policy`.
+# `policy` is a `RetryPolicy`, a dict of endpoint -> `RetryPolicy`, or None for `retry.DEFAULT_POLICIES`.
+def _safe_request(function, *args, policy=None, **kwargs) -> Response:
+    url = args[0] if args else kwargs.get("url", "")
+    state = select_policy(policy, url).start()
+    sink = metrics.active
+
+    while True:
+        try:
+            r = function(*args, **kwargs)
+        except Exception as e:
+            delay = state.onError()
+            if sink is not None:
+                _recordRequest(sink, url, state, "error", delay)
+            if delay is None:
+                print(f"giving up request after {e} error")
+                raise
+            print(f"retrying request after {e} error in {delay:.1f}s...")
+            sleep(delay)
+            continue
+
+        delay = state.onStatus(r.status_code)
+        if sink is not None:
+            _recordRequest(sink, url, state, r.status_code, delay)
+        if delay is None:
+            return r
+        print(f"retrying request after status {r.status_code} in {delay:.1f}s...")
+        sleep(delay)
+
+
+def _recordRequest(sink, url: str, state, outcome, delay) -> None:
+    endpoint = metrics.endpoint(url)
+    if delay is None:
+        sink.observe("cah_request_seconds", monotonic() - state.started, {"endpoint": endpoint, "status": str(outcome)})
+    else:
+        sink.inc("cah_request_retries_total", 1, {"endpoint": endpoint, "reason": str(outcome)})
 
 def _handle_exceptions(status_code: int, text: str) -> Optional[Exception]:
     if status_code == 200:
@@ -43,28 +92,46 @@ def _handle_exceptions(status_code: int, text: str) -> Optional[Exception]:
     else:
         return ServerError(f"[crawling@home] {text} (status {status_code})")
 
-# The main 'hybrid' client instance.
-class HybridClient:
-    def __init__(self, url, nickname, _recycled=False) -> None:
+# Every tracker endpoint used by the clients, resolved against the server URL once per client.
+ENDPOINTS = (
+    "api/new", "api/getUploadAddress", "api/jobCount", "api/newJob", "api/markAsDone",
+    "api/updateProgress", "api/validateWorker", "api/bye", "api/gpuInvalidDownload"
+)
+
+
+# The code shared by every client type. Subclasses set `TYPE` and override what differs per worker type.
+class _BaseClient:
+    TYPE = None
+    retry = None
+    _token = None
+    _jobs_label = "jobs remaining"
+    _result_key = "count"
+
+    def __init__(self, url, nickname, _recycled=False, retry=None, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, keep_alive=True) -> None:
+        self.retry = retry
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self._typed = {"type": self.TYPE}
+        self.job = None
+        self.jobs = deque()
+        self._siblings = []
+
         if _recycled:
             return
         
         if url[-1] != "/":
             url += "/"
         
-        self.s = session()
+        _printVersion()
+        self.s = make_session(pool_size, timeout, keep_alive)
         self.url = url
-        self.type = "HYBRID"
+        self.type = self.TYPE
         self.nickname = nickname
 
         print("connecting to crawling@home server...")
-        payload = {"nickname": nickname, "type": "HYBRID"}
-        r = _safe_request(self.s.get, self.url + "api/new", params=payload)
-
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
+        r = self._request("get", "api/new", params={"nickname": nickname, "type": self.TYPE})
 
         print("connected to crawling@home server")
         data = r.json()
@@ -74,283 +141,376 @@ class HybridClient:
         
         print(f"worker name: {self.display_name}")
         _builtin_print("\n\n")
-        print(f"You can view this worker's progress at {self.url + 'worker/hybrid/' + self.display_name}\n")
+        print(f"You can view this worker's progress at {self.url + 'worker/' + self.TYPE.lower() + '/' + self.display_name}\n")
     
     
-    # Finds the amount of available jobs from the server, returning an integer.
-    def updateUploadServer(self) -> None:
-        r = _safe_request(self.s.get, self.url + "api/getUploadAddress", params={"type": "HYBRID"})
+    # Setting the server URL (re)computes every endpoint URL.
+    @property
+    def url(self) -> str:
+        return self._url
+    
+    @url.setter
+    def url(self, url: str) -> None:
+        self._url = url
+        self._urls = {endpoint: url + endpoint for endpoint in ENDPOINTS}
+    
+    
+    # Setting the token (re)builds the authenticated payload template sent with most requests.
+    @property
+    def token(self) -> str:
+        return self._token
+    
+    @token.setter
+    def token(self, token: str) -> None:
+        self._token = token
+        self._auth = {"token": token, "type": self.TYPE}
+    
+    
+    # The payload authenticating the current job: that of the sibling registration that leased it (see `newJobs()`),
+    # or the client's own.
+    @property
+    def _jobAuth(self) -> dict:
+        job = getattr(self, "job", None)
+        if job is None or job.token == self.token:
+            return self._auth
+        return {"token": job.token, "type": self.TYPE}
+    
+    
+    # The payloads of every other registration holding a leased job (queued jobs leased by siblings).
+    def _queuedAuths(self) -> list:
+        current = self._jobAuth["token"]
+        tokens = {job.token for job in getattr(self, "jobs", ()) if job.token != current}
+        return [{"token": token, "type": self.TYPE} for token in tokens]
+    
+    
+    # Makes a request to `endpoint`, raising the server's error (after reporting a crash) on failure.
+    def _request(self, method: str, endpoint: str, **kwargs) -> Response:
+        r = _safe_request(getattr(self.s, method), self._urls[endpoint], policy=self.retry, **kwargs)
 
         exc = _handle_exceptions(r.status_code, r.text)
         if exc:
-            self.log("Crashed", crashed=True)
+            if self._token is not None:
+                self.log("Crashed", crashed=True)
             raise exc
 
+        return r
+    
+    
+    # Creates a new client registration with the same server, nickname and transport settings.
+    def _spawn(self):
+        sibling = type(self)(self.url, self.nickname, retry=self.retry, pool_size=self.pool_size,
+                             timeout=self.timeout, keep_alive=self.keep_alive)
+        sibling._cache = getattr(self, "_cache", None)
+        return sibling
+    
+    
+    # Updates the upload server.
+    def updateUploadServer(self) -> None:
+        r = self._request("get", "api/getUploadAddress", params=self._typed)
+
         self.upload_address = r.text
         
         print("updated upload server address")
     
     
-    # Updates the upload server.
+    # Uploads `filename` (e.g. from `packageImages()`) to the upload server in resumable, checksummed chunks, moving to a
+    # new server through `updateUploadServer()` if one keeps failing. Returns the URL to pass to `completeJob()`.
+    # Keyword arguments are passed on to `upload.Uploader`.
+    @traced("upload")
+    def upload(self, filename: str, name: str = None, **kwargs) -> str:
+        from .upload import Uploader
+        return Uploader(client=self, **kwargs).upload(filename, name)
+    
+    
+    # Finds the amount of available jobs from the server, returning an integer.
     def jobCount(self) -> int:
-        r = _safe_request(self.s.get, self.url + "api/jobCount", params={"type": "HYBRID"})
-
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
+        r = self._request("get", "api/jobCount", params=self._typed)
 
         count = int(r.text)
         
-        print(f"jobs remaining: {count}")
+        print(f"{self._jobs_label}: {count}")
 
         return count
-
+    
     
     # Makes the node send a request to the server, asking for a new job.
+    @traced("lease", begin=True)
     def newJob(self) -> None:
+        if getattr(self, "_dedup", None) is not None:
+            self._dedup.discard()
+
+        if getattr(self, "_prefetcher", None) is not None:
+            self._prefetcher.handover()
+            self.job = None
+            self._leased = monotonic()
+            print("recieved prefetched job")
+            return
+
+        if self.jobs:
+            self._install(self.jobs.popleft())
+            print(f"using queued job ({len(self.jobs)} left)")
+            return
+
         print("looking for new job...")
 
-        r = _safe_request(self.s.post, self.url + "api/newJob", json={"token": self.token, "type": "HYBRID"})
+        r = self._request("post", "api/newJob", json=self._auth)
 
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
-        else:
-            data = r.json()
-            self.shard = data["url"]
-            self.start_id = np.int64(data["start_id"])
-            self.end_id = np.int64(data["end_id"])
-            self.shard_piece = data["shard"]
-            
-            print("recieved new job")
+        self._install(Job.fromResponse(r.json(), self.token))
+        
+        print("recieved new job")
     
     
-    # Downloads the current job's shard to the current directory (./shard.wat)
-    def downloadShard(self, path="") -> None:
-        print("downloading shard...")
-        self.log("Downloading shard", noprint=True)
+    # Makes `job` the client's current job.
+    def _install(self, job: Job) -> None:
+        self.job = job
+        self._leased = monotonic()
+        self.shard = job.shard
+        self.start_id = job.start_id
+        self.end_id = job.end_id
+        self.shard_piece = job.shard_piece
+    
+    
+    # Leases up to `n` jobs into the local `jobs` queue, which `newJob()` then takes from without a round trip.
+    # Servers accepting a `count` lease them all at once; otherwise they are leased one at a time, each through
+    # its own worker registration. Returns the leased `Job`s. Only call this once the queued jobs are done.
+    def newJobs(self, n: int) -> list:
+        print(f"looking for {n} new jobs...")
 
-        with self.s.get(self.shard, stream=True) as r:
-            r.raise_for_status()
-            with open(path + "temp.gz", 'w+b') as f:
-                for chunk in r.iter_content(chunk_size=8192): 
-                    f.write(chunk)
-        
-        with gzip.open(path + 'temp.gz', 'rb') as f_in:
-            with open(path + 'shard.wat', 'w+b') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-        
-        sleep(1) # Causes errors otherwise?
-        os.remove(path + "temp.gz")
-
-        self.log("Downloaded shard", noprint=True)
-        print("finished downloading shard")
+        r = self._request("post", "api/newJob", json={**self._auth, "count": n})
 
+        data = r.json()
+        if isinstance(data, list):
+            self._multi = True
+            jobs = [Job.fromResponse(d, self.token) for d in data]
+        else:
+            jobs = [Job.fromResponse(data, self.token)]
+            while len(jobs) < n:
+                owner = self._siblings.pop() if self._siblings else self._spawn()
+                try:
+                    r = owner._request("post", "api/newJob", json=owner._auth)
+                except ZeroJobError:
+                    self._siblings.append(owner)
+                    break
+                jobs.append(Job.fromResponse(r.json(), owner.token, owner))
 
-    # Marks a job as completed/done.
-    def completeJob(self, total_scraped : int) -> None:
-        r = _safe_request(self.s.post, self.url + "api/markAsDone", json={"token": self.token, "count": total_scraped, "type": "HYBRID"})
+        self.jobs.extend(jobs)
         
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
-        
-        print("marked job as done")
+        print(f"recieved {len(jobs)} new jobs")
 
+        return jobs
     
-    # Wrapper for `completeJob` (for older workers)
-    def _markjobasdone(self, total_scraped : int) -> None:
-        print("WARNING: avoid using `_markjobasdone(...)` and instead use `completeJob(...)` to mark a job as done.")
-        self.completeJob(total_scraped)
-        
+    
+    # Starts leasing and downloading up to `depth` jobs in the background while the current one is processed.
+    # `newJob()` and `downloadShard()` then hand over prefetched jobs instead of contacting the server.
+    def enablePrefetch(self, depth=1, path="", chunk_size=None, segments=1) -> None:
+        if getattr(self, "_prefetcher", None) is None:
+            self._prefetcher = Prefetcher(self, depth, path, chunk_size, segments)
+            print(f"prefetching up to {depth} job(s) ahead")
+    
+    
+    # Moves a prefetched job's shard into `path`, returning False if the current job wasn't prefetched.
+    def _unstage(self, path) -> bool:
+        if getattr(self, "_staged", None) is None:
+            return False
 
-    # Logs the string progress into the server.
-    def log(self, progress : str, crashed=False, noprint=False) -> None:
-        data = {"token": self.token, "progress": progress, "type": "HYBRID"}
+        unstage(self._staged, path)
+        self._staged = None
+        print("using prefetched shard")
+        return True
+    
+    
+    # Downloads the current job's shard to the current directory (./shard.wat)
+    @traced("download")
+    def downloadShard(self, path="", chunk_size=None, segments=1) -> None:
+        if self._unstage(path):
+            return
+
+        print("downloading shard...")
+        self.log("Downloading shard", noprint=True)
 
-        r = _safe_request(self.s.post, self.url + "api/updateProgress", json=data)
+        if getattr(self, "_cache", None) is not None:
+            if self._cache.fetch(self.s, self.shard, path + "shard.wat", chunk_size, segments):
+                print("using cached shard")
+        else:
+            fetch_shard(self.s, self.shard, path + "shard.wat", chunk_size, segments)
 
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc and not crashed:
-            self.log("Crashed", crashed=True)
-            raise exc
-        
-        if not crashed and not noprint:
-            print(f"logged new progress data: {progress}")
+        self.log("Downloaded shard", noprint=True)
+        print("finished downloading shard")
     
     
-    # Client wrapper for `recycler.dump`.
-    def dump(self) -> dict:
-        from .recycler import dump as _dump
-        return _dump(self)
+    # Iterates over the WAT records of the current job's `shard_piece` in the downloaded `path` + shard.wat.
+    # Records are read from a memory map, so the WAT is never loaded into memory (see `wat.iter_records`).
+    def iterRecords(self, path="") -> Iterator[WatRecord]:
+        return iter_records(path + "shard.wat", self.shard_piece)
     
     
-    def recreate(self) -> None:
-        print("recreating client instance...")
-        new = HybridClient(self.url, self.nickname)
-        self.token = new.token
-        self.display_name = new.display_name
-        self.upload_address = new.upload_address
+    # Iterates over the WAT records of the current job's `shard_piece` straight from the compressed download,
+    # without `downloadShard()`. Pieces are split as in `iterRecords()` (see `wat.iter_gzip_records`).
+    def streamRecords(self, chunk_size=None) -> Iterator[WatRecord]:
+        return iter_url_records(self.s, self.shard, self.shard_piece, chunk_size=chunk_size)
     
     
-    # Returns True if the worker is still alive, otherwise returns False.
-    def isAlive(self) -> bool:
-        r = _safe_request(self.s.post, self.url + "api/validateWorker", json={"token": self.token, "type": "HYBRID"})
+    # Extracts the image/alt-text candidates of the current job's `shard_piece` from `path` + shard.wat as columnar
+    # batches, with sample ids assigned from the job's `start_id` range (see `extract.extract`).
+    # With `enableDedup()`, candidates already seen in a completed job are dropped.
+    def extractCandidates(self, path="", filters=None, batch_size=8192) -> Iterator["CandidateBatch"]:
+        from .extract import DEFAULT_FILTERS, extract
 
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
-        else:
-            return ("True" in r.text)
+        filters = DEFAULT_FILTERS if filters is None else filters
+        return extract(self.iterRecords(path), self.start_id, self.end_id, filters, batch_size,
+                       getattr(self, "_dedup", None))
     
     
-    # Removes the node instance from the server, ending all current jobs.
-    def bye(self) -> None:
-        _safe_request(self.s.post, self.url + "api/bye", json={"token": self.token, "type": "HYBRID"})
-        print("closed worker")
-
-        
-        
-# The CPU client instance.
-# Programatically similar to `HybridClient`, with different completion functions.
-class CPUClient:
-    def __init__(self, url, nickname, _recycled=False) -> None:
-        if _recycled:
-            return
-        
-        if url[-1] != "/":
-            url += "/"
-        
-        self.s = session()
-        self.url = url
-        self.type = "CPU"
-        self.nickname = nickname
-
-        print("connecting to crawling@home server...")
-        payload = {"nickname": nickname, "type": "CPU"}
-        r = _safe_request(self.s.get, self.url + "api/new", params=payload)
-
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
-
-        print("connected to crawling@home server")
-        data = r.json()
-        self.token = data["token"]
-        self.display_name = data["display_name"]
-        self.upload_address = data["upload_address"]
-        
-        print(f"worker name: {self.display_name}")
-        _builtin_print("\n\n")
-        print(f"You can view this worker's progress at {self.url + 'worker/cpu/' + self.display_name}\n")
-        
+    # Fetches the images of `candidates` (see `extractCandidates()`) concurrently, yielding each `FetchedImage` as it
+    # arrives and reporting progress through `log()`. Keyword arguments are passed on to `fetch.ImageFetcher`.
+    def fetchImages(self, candidates, yield_failures=False, **kwargs) -> Iterator["FetchedImage"]:
+        from .fetch import ImageFetcher
+        return ImageFetcher(client=self, **kwargs).fetch(candidates, yield_failures)
     
-    # Finds the amount of available jobs from the server, returning an integer.
-    def updateUploadServer(self) -> None:
-        r = _safe_request(self.s.get, self.url + "api/getUploadAddress", params={"type": "CPU"})
-
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
-
-        self.upload_address = r.text
-        
-        print("updated upload server address")
     
+    # Shares downloaded shards with the other workers on the host through a `cache.ShardCache` at `path`, so a shard
+    # leased by several workers (e.g. both `shard_piece` halves) is only downloaded once. Bounded to `max_size` bytes.
+    def enableCache(self, path=None, max_size=None) -> None:
+        if getattr(self, "_cache", None) is None:
+            from . import cache
+            self._cache = cache.ShardCache(path or cache.DEFAULT_PATH, max_size or cache.DEFAULT_MAX_SIZE)
+            print(f"caching shards in {self._cache.path}")
     
-    # Finds the amount of available jobs from the server, returning an integer.
-    def jobCount(self) -> int:
-        r = _safe_request(self.s.get, self.url + "api/jobCount", params={"type": "CPU"})
+    
+    # Drops candidates already extracted by a completed job, using a persistent Bloom filter at `path`
+    # (shared by every worker on the host that uses the same file). Keys are normalized URLs, plus alt text if `with_alt`.
+    def enableDedup(self, path="dedup.bloom", capacity=100_000_000, error_rate=0.001, with_alt=False) -> None:
+        if getattr(self, "_dedup", None) is None:
+            from .dedup import BloomFilter, Deduplicator
+            self._dedup = Deduplicator(BloomFilter(path, capacity, error_rate), with_alt)
+            print(f"deduplicating candidates against {path} ({self._dedup.bloom.count} seen)")
+    
+    
+    # Runs before marking jobs as done: pending progress must reach the server first.
+    def _beforeDone(self) -> None:
+        if getattr(self, "_logger", None) is not None:
+            self._logger.flush()
+    
+    
+    # Runs after marking jobs as done: commits deduplicated candidates and hands over the next prefetched job.
+    def _afterDone(self) -> None:
+        print("marked job as done")
 
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
+        if metrics.active is not None and getattr(self, "_leased", None) is not None:
+            metrics.active.observe("cah_job_seconds", monotonic() - self._leased, {"type": self.TYPE})
+            self._leased = None
 
-        count = int(r.text)
-        
-        print(f"jobs remaining: {count}")
+        if getattr(self, "_dedup", None) is not None:
+            self._dedup.commit()
 
-        return count
+        if getattr(self, "_prefetcher", None) is not None:
+            self._prefetcher.release()
+            self._prefetcher.handover(block=False)
     
     
-    # Makes the node send a request to the server, asking for a new job.
-    def newJob(self) -> None:
-        print("looking for new job...")
-
-        r = _safe_request(self.s.post, self.url + "api/newJob", json={"token": self.token, "type": "CPU"})
+    # Marks `job` (by default the current job) as done with `payload`.
+    @traced("complete", end=True)
+    def _markAsDone(self, payload: dict, job: Job = None) -> None:
+        self._beforeDone()
+        self._complete(job or self.job, payload)
+        self._afterDone()
+    
+    
+    def _complete(self, job: Optional[Job], payload: dict) -> None:
+        auth = self._auth if job is None else {"token": job.token, "type": self.TYPE}
+        if job is not None and getattr(self, "_multi", False):
+            # the registration holds several jobs: name the one completed
+            payload = {**payload, "job": {"url": job.shard, "shard": job.shard_piece}}
+        self._request("post", "api/markAsDone", json={**auth, **payload})
 
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
-        else:
-            data = r.json()
-            self.shard = data["url"]
-            self.start_id = np.int64(data["start_id"])
-            self.end_id = np.int64(data["end_id"])
-            self.shard_piece = data["shard"]
-            
-            print("recieved new job")
+        if job is not None and job._owner is not None:
+            self._siblings.append(job._owner)
+            job._owner = None
+        if job is self.job:
+            self.job = None
     
     
-    # Downloads the current job's shard to the current directory (./shard.wat)
-    def downloadShard(self, path="") -> None:
-        print("downloading shard...")
-        self.log("Downloading shard", noprint=True)
+    # Marks a job as completed/done. `job` defaults to the current job.
+    def completeJob(self, total_scraped : int, job : Job = None) -> None:
+        self._markAsDone({"count": total_scraped}, job)
+    
+    
+    # Marks several jobs as done, given a list of (`Job`, result) pairs where result is what `completeJob()` takes.
+    # Servers that lease several jobs at once are sent every completion in a single request.
+    @traced("complete", end=True)
+    def completeJobs(self, results: list) -> None:
+        self._beforeDone()
 
-        with self.s.get(self.shard, stream=True) as r:
-            r.raise_for_status()
-            with open(path + "temp.gz", 'w+b') as f:
-                for chunk in r.iter_content(chunk_size=8192): 
-                    f.write(chunk)
-            
-        with gzip.open(path + 'temp.gz', 'rb') as f_in:
-            with open(path + 'shard.wat', 'w+b') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-            
-        sleep(1) # Causes errors otherwise?
-        os.remove(path + "temp.gz")
+        if getattr(self, "_multi", False):
+            self._request("post", "api/markAsDone", json={**self._auth, "jobs": [
+                {"job": {"url": job.shard, "shard": job.shard_piece}, self._result_key: result} for job, result in results
+            ]})
+            if any(job is self.job for job, _ in results):
+                self.job = None
+        else:
+            for job, result in results:
+                self._complete(job, {self._result_key: result})
 
-        self.log("Downloaded shard", noprint=True)
-        print("finished downloading shard")
-        
-    
-    # Uploads the image download URL for the GPU workers to use, marking the CPU job complete.
-    def completeJob(self, image_download_url : str) -> None:
-        r = _safe_request(self.s.post, self.url + "api/markAsDone", json={
-            "token": self.token,
-            "url": image_download_url,
-            "type": "CPU"
-        })
-        
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
-        
-        print("marked job as done")
+        self._afterDone()
     
     
     # Logs the string progress into the server.
+    # With `enableAsyncLog()`, progress is sent in the background; "Crashed" reports are always sent immediately.
     def log(self, progress : str, crashed=False, noprint=False) -> None:
-        data = {"token": self.token, "progress": progress, "type": "CPU"}
+        if not crashed and getattr(self, "_logger", None) is not None:
+            self._logger.submit(progress)
+        else:
+            self._postProgress(progress, crashed)
+        
+        if not crashed and not noprint:
+            print(f"logged new progress data: {progress}")
 
-        r = _safe_request(self.s.post, self.url + "api/updateProgress", json=data)
+        trace.instant(self, progress)
+    
+    
+    # Returns a context manager recording the block as a span on the current job's timeline (see `trace.enable`).
+    def span(self, name: str, **args):
+        return trace.span(self, name, **args)
+    
+    
+    # Sends a progress update to the server (blocking).
+    def _postProgress(self, progress : str, crashed=False) -> None:
+        r = _safe_request(self.s.post, self._urls["api/updateProgress"], policy=self.retry,
+                          json={**self._jobAuth, "progress": progress})
 
         exc = _handle_exceptions(r.status_code, r.text)
         if exc and not crashed:
             self.log("Crashed", crashed=True)
             raise exc
-        
-        if not crashed and not noprint:
-            print(f"logged new progress data: {progress}")
+    
+    
+    # Makes `log()` non-blocking: updates are coalesced and sent at most once every `interval` seconds.
+    # Outstanding updates are flushed by `completeJob()` and `bye()`.
+    def enableAsyncLog(self, interval=5.0) -> None:
+        if getattr(self, "_logger", None) is None:
+            self._logger = ProgressLogger(self, interval)
+    
+    
+    # Starts validating the worker every `interval` seconds in a background thread (the server may change the
+    # interval), so `isAlive()` and `alive` become local checks. `on_evicted(client)` is called once the server
+    # drops the worker; `recreate()` then registers again and restarts the heartbeat.
+    def enableHeartbeat(self, interval=60.0, on_evicted=None) -> None:
+        if getattr(self, "_heartbeat", None) is None:
+            self._heartbeat = Heartbeat(self, interval, on_evicted)
+    
+    
+    # Whether the worker is still registered as of the last heartbeat (always True without `enableHeartbeat()`).
+    @property
+    def alive(self) -> bool:
+        heartbeat = getattr(self, "_heartbeat", None)
+        return heartbeat is None or heartbeat.alive
+    
+    
+    # A `threading.Event` set once the heartbeat finds the worker evicted (None without `enableHeartbeat()`).
+    @property
+    def evicted(self):
+        heartbeat = getattr(self, "_heartbeat", None)
+        return heartbeat and heartbeat.evicted
     
     
     # Client wrapper for `recycler.dump`.
@@ -362,118 +522,97 @@ class CPUClient:
     # Recreates the client with the server, giving the client a new auth token, upload server and display name.
     def recreate(self) -> None:
         print("recreating client instance...")
-        new = CPUClient(self.url, self.nickname)
+        new = self._spawn()
         self.token = new.token
         self.display_name = new.display_name
         self.upload_address = new.upload_address
+
+        heartbeat = getattr(self, "_heartbeat", None)
+        if heartbeat is not None:
+            heartbeat.stop()
+            self._heartbeat = Heartbeat(self, heartbeat.interval, heartbeat.on_evicted)
     
     
     # Returns True if the worker is still alive, otherwise returns False.
     def isAlive(self) -> bool:
-        r = _safe_request(self.s.post, self.url + "api/validateWorker", json={"token": self.token, "type": "CPU"})
+        if getattr(self, "_heartbeat", None) is not None:
+            return self._heartbeat.alive
 
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
-        else:
-            return ("True" in r.text)
+        r = self._request("post", "api/validateWorker", json=self._jobAuth)
+
+        return ("True" in r.text)
     
     
     # Removes the node instance from the server, ending all current jobs.
     def bye(self) -> None:
-        _safe_request(self.s.post, self.url + "api/bye", json={"token": self.token, "type": "CPU"})
+        if getattr(self, "_heartbeat", None) is not None:
+            self._heartbeat.stop()
+            self._heartbeat = None
+        if getattr(self, "_logger", None) is not None:
+            self._logger.close()
+            self._logger = None
+        if getattr(self, "_prefetcher", None) is not None:
+            self._prefetcher.stop()
+            self._prefetcher = None
+        for sibling in self._siblings + [job._owner for job in self.jobs if job._owner is not None]:
+            sibling.bye()
+        self._siblings = []
+        self.jobs.clear()
+
+        _safe_request(self.s.post, self._urls["api/bye"], policy=self.retry, json=self._auth)
         print("closed worker")
 
 
 
-# The GPU client instance.
-class GPUClient:
-    def __init__(self, url, nickname, _recycled=False) -> None:
-        if _recycled:
-            return
-        
-        if url[-1] != "/":
-            url += "/"
-        
-        self.s = session()
-        self.url = url
-        self.type = "GPU"
-        self.nickname = nickname
+# The main 'hybrid' client instance.
+class HybridClient(_BaseClient):
+    TYPE = "HYBRID"
+    
+    
+    # Wrapper for `completeJob` (for older workers)
+    def _markjobasdone(self, total_scraped : int) -> None:
+        print("WARNING: avoid using `_markjobasdone(...)` and instead use `completeJob(...)` to mark a job as done.")
+        self.completeJob(total_scraped)
 
-        print("connecting to crawling@home server...")
-        payload = {"nickname": nickname, "type": "GPU"}
-        r = _safe_request(self.s.get, self.url + "api/new", params=payload)
 
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
 
-        print("connected to crawling@home server")
-        data = r.json()
-        self.token = data["token"]
-        self.display_name = data["display_name"]
-        self.upload_address = data["upload_address"]
-        
-        print(f"worker name: {self.display_name}")
-        _builtin_print("\n\n")
-        print(f"You can view this worker's progress at {self.url + 'worker/gpu/' + self.display_name}\n")
+# The CPU client instance.
+# Programatically similar to `HybridClient`, with different completion functions.
+class CPUClient(_BaseClient):
+    TYPE = "CPU"
+    _result_key = "url"
     
     
-    # Finds the amount of available jobs from the server, returning an integer.
-    def updateUploadServer(self) -> None:
-        r = _safe_request(self.s.get, self.url + "api/getUploadAddress", params={"type": "GPU"})
-
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
-
-        self.upload_address = r.text
-        
-        print("updated upload server address")
+    # Uploads the image download URL for the GPU workers to use, marking the CPU job complete.
+    def completeJob(self, image_download_url : str, job : Job = None) -> None:
+        self._markAsDone({"url": image_download_url}, job)
     
     
-    # Finds the amount of available jobs from the server, returning an integer.
-    def jobCount(self) -> int:
-        r = _safe_request(self.s.get, self.url + "api/jobCount", params={"type": "GPU"})
+    # Packages images (e.g. from `fetchImages()`) into the job's `.tar.gz` at `filename` while they arrive, compressing
+    # it in parallel, and returns its path once the last image is in. Keyword arguments are passed on to
+    # `archive.ArchiveWriter`. Publish the archive and pass its URL to `completeJob()`.
+    @traced("package")
+    def packageImages(self, images, path="", filename=None, **kwargs) -> str:
+        from .archive import ArchiveWriter
 
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
+        filename = path + (filename or f"images_{int(self.start_id)}_{int(self.end_id)}.tar.gz")
+        with ArchiveWriter(filename, **kwargs) as archive:
+            n = archive.addImages(images)
 
-        count = int(r.text)
-        
-        print(f"GPU jobs remaining: {count}")
+        self.log(f"Packaged {n} images", noprint=True)
+        return filename
 
-        return count
-    
-    
-    # Makes the node send a request to the server, asking for a new job.
-    def newJob(self) -> None:
-        print("looking for new job...")
 
-        r = _safe_request(self.s.post, self.url + "api/newJob", json={"token": self.token, "type": "GPU"})
 
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
-        else:
-            data = r.json()
-            self.shard = data["url"]
-            self.start_id = np.int64(data["start_id"])
-            self.end_id = np.int64(data["end_id"])
-            self.shard_piece = data["shard"]
-            
-            print("recieved new job")
-            
+# The GPU client instance.
+class GPUClient(_BaseClient):
+    TYPE = "GPU"
+    _jobs_label = "GPU jobs remaining"
+    
     
     # Flags a GPU job's URL as invalid to the server.
     def invalidURL(self) -> None:
-        r = _safe_request(self.s.post, self.url + "api/gpuInvalidDownload", json={"token": self.token, "type": "GPU"})
+        r = _safe_request(self.s.post, self._urls["api/gpuInvalidDownload"], policy=self.retry, json=self._auth)
         
         if r.status_code != 200:
             print("something went wrong when flagging a URL as invalid - not raising error.")
@@ -482,113 +621,57 @@ class GPUClient:
         raise InvalidURLError('[crawling@home] Invalid URL')
     
     
-    # Downloads the CPU worker's processed images to the ./images/ (`path`) directory
-    def downloadShard(self, path="") -> None:
+    # Downloads the CPU worker's processed images into the `path` directory, extracting them while they transfer.
+    # The names of the extracted files are kept in `members`.
+    @traced("download")
+    def downloadShard(self, path="", chunk_size=None, segments=1) -> None:
+        if self._unstage(path):
+            return
+
+        from . import tarstream
+
         print("downloading shard...")
         self.log("Downloading shard", noprint=True)
 
-        if self.shard.startswith('http'):
-            with self.s.get(self.shard, stream=True) as r:
-                r.raise_for_status()
-                with open(path + "temp.gz", 'w+b') as f:
-                    for chunk in r.iter_content(chunk_size=8192): 
-                        f.write(chunk)
-            
-            with gzip.open(path + 'temp.gz', 'rb') as f_in:
-                with open(path + 'shard.wat', 'w+b') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            
-            sleep(1) # Causes errors otherwise?
-            os.remove(path + "temp.gz")
+        if self.shard.startswith(('http', 'file://')):
+            self.members = tarstream.fetch_extract(self.s, self.shard, path)
         elif self.shard.startswith('rsync'):
             uid = self.shard.split('rsync', 1)[-1].strip()
-            resp = 1
             for _ in range(5):
-                resp = os.system(f'rsync -av archiveteam@5.9.55.230::gpujobs/{uid}.tar.gz {uid}.tar.gz')
-                if resp == 5888:
+                resp, members = tarstream.rsync_extract(f"{tarstream.RSYNC_SOURCE}{uid}.tar.gz", f"{path}{uid}.tar.gz", path)
+                if resp == tarstream.RSYNC_NOT_FOUND:
                     print('[crawling@home] rsync job not found')
                     self.invalidURL()
                 if resp == 0:
-                    with tarfile.open(f"{uid}.tar.gz", "r:gz") as tar:
-                        tar.extractall()
+                    self.members = members
                     break
+            else:
+                raise IncompleteArchiveError(f"[crawling@home] unable to download {uid}.tar.gz (rsync exit code {resp})")
         else:
             self.invalidURL()
 
         self.log("Downloaded shard", noprint=True)
         print("finished downloading shard")
-        
-    
-    # Uploads the image download URL for the GPU workers to use, marking the CPU job complete.
-    def completeJob(self, total_scraped : int) -> None:
-        r = _safe_request(self.s.post, self.url + "api/markAsDone", json={"token": self.token, "count": total_scraped, "type": "GPU"})
-        
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
-        
-        print("marked job as done")
-    
-    
-    # Logs the string progress into the server.
-    def log(self, progress : str, crashed=False, noprint=False) -> None:
-        data = {"token": self.token, "progress": progress, "type": "GPU"}
-
-        r = _safe_request(self.s.post, self.url + "api/updateProgress", json=data)
-
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc and not crashed:
-            self.log("Crashed", crashed=True)
-            raise exc
-        
-        if not crashed and not noprint:
-            print(f"logged new progress data: {progress}")
-    
-    
-    # Client wrapper for `recycler.dump`.
-    def dump(self) -> dict:
-        from .recycler import dump as _dump
-        return _dump(self)
     
     
-    # Recreates the client with the server, giving the client a new auth token, upload server and display name.
-    def recreate(self) -> None:
-        print("recreating client instance...")
-        new = GPUClient(self.url, self.nickname)
-        self.token = new.token
-        self.display_name = new.display_name
-        self.upload_address = new.upload_address
-    
-    
-    # Returns True if the worker is still alive, otherwise returns False.
-    def isAlive(self) -> bool:
-        r = _safe_request(self.s.post, self.url + "api/validateWorker", json={"token": self.token, "type": "GPU"})
-
-        exc = _handle_exceptions(r.status_code, r.text)
-        if exc:
-            self.log("Crashed", crashed=True)
-            raise exc
-        else:
-            return ("True" in r.text)
-    
-    
-    # Removes the node instance from the server, ending all current jobs.
-    def bye(self) -> None:
-        _safe_request(self.s.post, self.url + "api/bye", json={"token": self.token, "type": "GPU"})
-        print("closed worker")
+    # Returns an `ImageLoader` feeding batches of decoded images (with their sample ids and alt texts) from the
+    # shard extracted to `path` by `downloadShard()`. Keyword arguments are passed on to `ImageLoader`.
+    def loadImages(self, path="", batch_size=256, **kwargs) -> "ImageLoader":
+        from .loader import ImageLoader
+        return ImageLoader(path or ".", batch_size, **kwargs)
 
 
-# Creates and returns a new client instance.
-def init(url="http://crawlingathome.duckdns.org/", nickname="anonymous", type="Hybrid") -> Optional[Union[HybridClient, CPUClient, GPUClient]]:
+# `retry` optionally overrides the retry policy: a `RetryPolicy`, or a dict of endpoint -> `RetryPolicy`.
+# Any other keyword arguments (`pool_size`, `timeout`, `keep_alive`) configure the client's connection pool.
+def init(url="http://crawlingathome.duckdns.org/", nickname="anonymous", type="Hybrid", retry=None, **kwargs) -> Optional[Union[HybridClient, CPUClient, GPUClient]]:
     if isinstance(type, str):
         type = type.lower()[0]
         
     if type == "h" or type == HybridClient:
-        return HybridClient(url, nickname)
+        return HybridClient(url, nickname, retry=retry, **kwargs)
     elif type == "c" or type == CPUClient:
-        return CPUClient(url, nickname)
+        return CPUClient(url, nickname, retry=retry, **kwargs)
     elif type == "g" or type == GPUClient:
-        return GPUClient(url, nickname)
+        return GPUClient(url, nickname, retry=retry, **kwargs)
     else:
         raise ValueError(f"[crawling@home] invalid worker `{type}`")
@@ -0,0 +1,171 @@
+from urllib.parse import urlsplit, urlunsplit
+from hashlib import blake2b
+import numpy as np
+import struct
+import fcntl
+import math
+import mmap
+import os
+
+_MAGIC = b"CAHBLOOM"
+_VERSION = 1
+_HEADER = struct.Struct("<8sIQIQ")  # magic, version, bit count, hash count, items added
+_HEADER_SIZE = 64                   # bits start here, keeping them 64-byte aligned
+
+
+# Normalizes a URL for deduplication: lowercases the scheme and host, drops default ports and the fragment.
+def normalize_url(url: str) -> str:
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme == "http" and netloc.endswith(":80")) or (scheme == "https" and netloc.endswith(":443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+# The 128-bit digest of a key, split into the two 64-bit hashes used for double hashing.
+def _digest(key: str) -> bytes:
+    return blake2b(key.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+
+# A memory-bounded Bloom filter stored in a memory-mapped file, so it persists across jobs and can be shared
+# by every worker on a host that maps the same file. Concurrent writers may occasionally lose a bit update,
+# which can only let a duplicate through, never drop a new item.
+class BloomFilter:
+    def __init__(self, path: str, capacity: int = 100_000_000, error_rate: float = 0.001) -> None:
+        self.path = path
+
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            m = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+            m += -m % 512  # whole 64-byte blocks
+            k = max(1, round(m / capacity * math.log(2)))
+            with open(path, "ab") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                if f.tell() == 0:
+                    f.write(_HEADER.pack(_MAGIC, _VERSION, m, k, 0).ljust(_HEADER_SIZE, b"\0"))
+                    f.truncate(_HEADER_SIZE + m // 8)
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        self._f = open(path, "r+b")
+        self._mm = mmap.mmap(self._f.fileno(), 0)
+
+        magic, version, self.m, self.k, _ = _HEADER.unpack_from(self._mm)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f"[crawling@home] {path} is not a version {_VERSION} dedup filter")
+
+        self._bits = np.frombuffer(self._mm, dtype=np.uint8, count=self.m // 8, offset=_HEADER_SIZE)
+
+    # The approximate amount of items added, across every worker sharing the file.
+    @property
+    def count(self) -> int:
+        return _HEADER.unpack_from(self._mm)[4]
+
+    # The bit positions of every digest in `digests`, as a (len(digests), k) array.
+    def _positions(self, digests) -> np.ndarray:
+        h = np.frombuffer(b"".join(digests), dtype="<u8").reshape(-1, 2)
+        i = np.arange(self.k, dtype=np.uint64)
+        with np.errstate(over="ignore"):
+            return (h[:, :1] + i * h[:, 1:]) % np.uint64(self.m)
+
+    # Returns a boolean array: whether each digest has (probably) been added before.
+    def containsDigests(self, digests) -> np.ndarray:
+        if not digests:
+            return np.zeros(0, dtype=bool)
+        pos = self._positions(digests)
+        bits = (self._bits[pos >> np.uint64(3)] >> (pos & np.uint64(7)).astype(np.uint8)) & 1
+        return bits.all(axis=1)
+
+    # Adds every digest in `digests` to the filter.
+    def addDigests(self, digests) -> None:
+        if not digests:
+            return
+        pos = self._positions(digests).ravel()
+        np.bitwise_or.at(self._bits, pos >> np.uint64(3), (1 << (pos & np.uint64(7))).astype(np.uint8))
+        self._bumpCount(len(digests))
+
+    def __contains__(self, key: str) -> bool:
+        return bool(self.containsDigests([_digest(key)])[0])
+
+    def add(self, key: str) -> None:
+        self.addDigests([_digest(key)])
+
+    def _bumpCount(self, n: int) -> None:
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+        try:
+            header = list(_HEADER.unpack_from(self._mm))
+            header[4] += n
+            _HEADER.pack_into(self._mm, 0, *header)
+        finally:
+            fcntl.flock(self._f, fcntl.LOCK_UN)
+
+    # ORs another filter (a `BloomFilter` or the path to one) with the same size into this one.
+    def merge(self, other) -> None:
+        if isinstance(other, str):
+            other = BloomFilter(other)
+        if (other.m, other.k) != (self.m, self.k):
+            raise ValueError("[crawling@home] can only merge dedup filters of the same size")
+
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+        try:
+            np.bitwise_or(self._bits, other._bits, out=self._bits)
+            header = list(_HEADER.unpack_from(self._mm))
+            header[4] += other.count
+            _HEADER.pack_into(self._mm, 0, *header)
+        finally:
+            fcntl.flock(self._f, fcntl.LOCK_UN)
+
+    # Writes pending changes to disk.
+    def flush(self) -> None:
+        self._mm.flush()
+
+    def close(self) -> None:
+        self.flush()
+        del self._bits
+        self._mm.close()
+        self._f.close()
+
+
+# Deduplicates job candidates against a `BloomFilter`, keyed by normalized URL (and alt text if `with_alt`).
+# Candidates are only marked as seen by `commit()` (i.e. once their job is completed), so a crashed job's
+# candidates are handed out again; duplicates within the current job are dropped straight away.
+class Deduplicator:
+    def __init__(self, bloom: BloomFilter, with_alt: bool = False) -> None:
+        self.bloom = bloom
+        self.with_alt = with_alt
+        self._pending = {}
+        self.dropped = 0
+
+    def _key(self, url: str, alt: str) -> str:
+        url = normalize_url(url)
+        return url + "\t" + alt if self.with_alt else url
+
+    # Returns the indices of the candidates not yet seen in a completed job or earlier in this one, in order and
+    # stopping after `limit` of them. Only the selected candidates are remembered, so run this after every other
+    # filter: candidates dropped elsewhere are still new to a later job.
+    def select(self, urls: np.ndarray, alts: np.ndarray, limit: int = None) -> np.ndarray:
+        digests = [_digest(self._key(u, a)) for u, a in zip(urls, alts)]
+        fresh = ~self.bloom.containsDigests(digests) if digests else np.zeros(0, dtype=bool)
+
+        selected = []
+        for i, d in enumerate(digests):
+            if limit is not None and len(selected) >= limit:
+                break
+            if fresh[i] and d not in self._pending:
+                self._pending[d] = None
+                selected.append(i)
+            else:
+                self.dropped += 1
+        return np.array(selected, dtype=np.int64)
+
+    # Marks every candidate kept since the last commit as seen.
+    def commit(self) -> None:
+        self.bloom.addDigests(list(self._pending))
+        self.bloom.flush()
+        self._pending.clear()
+
+    # Forgets the candidates kept since the last commit.
+    def discard(self) -> None:
+        self._pending.clear()
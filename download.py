@@ -0,0 +1,352 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep, monotonic, perf_counter
+from array import array
+import json
+import zlib
+import os
+
+from . import metrics
+
+# Default read buffer used when streaming shards from the server (1 MiB).
+CHUNK_SIZE = 1 << 20
+
+# Default amount of times a dropped stream or failed segment is retried before giving up.
+RETRIES = 5
+
+# Segments smaller than this are not worth their own connection (8 MiB).
+MIN_SEGMENT_SIZE = 8 << 20
+
+# Suffix of the index written next to every decompressed shard (`shard.wat.members`, JSON), mapping where each
+# gzip member starts in the decompressed shard to where it started in the download (see `wat.iter_records`).
+MEMBERS_SUFFIX = ".members"
+
+
+# Incrementally inflates a (possibly multi-member) gzip stream.
+# CommonCrawl WATs are concatenated gzip members, so a fresh decompressor is started every time one member ends.
+# `seconds` is the time spent decompressing. `flush()` raises `EOFError` if the stream ends inside a member.
+# `marks` holds the (decompressed offset, compressed offset) pairs, flattened, where every member after the first starts.
+class GunzipStream:
+    def __init__(self) -> None:
+        self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._started = False   # whether the current member has received any input
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+        self.marks = array("q")
+
+    def feed(self, data: bytes) -> bytes:
+        started = perf_counter()
+        offset = self.bytes_in      # compressed offset of data[0]
+        produced = self.bytes_out   # decompressed offset of the output so far
+        self.bytes_in += len(data)
+        out = []
+
+        while data:
+            self._started = True
+            out.append(self._d.decompress(data))
+            produced += len(out[-1])
+            if not self._d.eof:
+                break
+
+            unused = self._d.unused_data
+            offset += len(data) - len(unused)
+            data = unused
+            self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._started = False
+            self.marks.extend((produced, offset))
+
+        chunk = b"".join(out)
+        self.bytes_out += len(chunk)
+        self.seconds += perf_counter() - started
+        return chunk
+
+    def flush(self) -> bytes:
+        if self._started and not self._d.eof:
+            # checked before flushing, so the stream can still be resumed by feeding the rest
+            raise EOFError(f"[crawling@home] gzip stream ended early after {self.bytes_in} bytes")
+        chunk = self._d.flush()
+        self.bytes_out += len(chunk)
+        return chunk
+
+
+# Writes the member index of the shard decompressed by `gz` to `path` + MEMBERS_SUFFIX.
+def _save_members(path: str, gz: GunzipStream) -> None:
+    members = [[0, 0]] + [[gz.marks[i], gz.marks[i + 1]] for i in range(0, len(gz.marks), 2)]
+    with open(path + MEMBERS_SUFFIX + ".tmp", "w") as f:
+        json.dump({"version": 1, "size": gz.bytes_in, "members": members}, f)
+    os.replace(path + MEMBERS_SUFFIX + ".tmp", path + MEMBERS_SUFFIX)
+
+
+# Returns the member index written next to the decompressed shard at `path`, or None if it has none.
+def read_members(path: str):
+    try:
+        with open(path + MEMBERS_SUFFIX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# Reports a finished download of `size` compressed bytes started at `started` (a `monotonic()` time),
+# and the time `gz` spent decompressing it.
+def _record(kind: str, size: int, started: float, gz: GunzipStream = None) -> None:
+    sink = metrics.active
+    if sink is None:
+        return
+    sink.inc("cah_download_bytes_total", size, {"kind": kind})
+    sink.observe("cah_download_seconds", monotonic() - started, {"kind": kind})
+    if gz is not None:
+        sink.inc("cah_gunzip_seconds_total", gz.seconds)
+
+
+# Sleeps before the `attempt`-th retry of a dropped download, capped at 30 seconds.
+def _backoff(attempt: int) -> None:
+    sleep(min(2 ** attempt, 30))
+
+
+# Streams a gzipped `url` through `s` (a requests session), inflating it straight into `out_path` as it arrives.
+# If the connection drops, the stream is resumed from the last received byte with a range request, or restarted
+# from scratch when the server ignores ranges. Returns the number of decompressed bytes written.
+# The partial output is removed if the download ultimately fails. The member index is written along with it.
+def stream_gunzip(s, url: str, out_path: str, chunk_size: int = None, retries: int = None) -> int:
+    chunk_size = chunk_size or CHUNK_SIZE
+    retries = RETRIES if retries is None else retries
+    gz = GunzipStream()
+    attempt = 0
+    started = monotonic()
+    _remove(out_path + MEMBERS_SUFFIX)
+
+    try:
+        with open(out_path, "wb", buffering=chunk_size) as f:
+            while True:
+                headers = {"Range": f"bytes={gz.bytes_in}-"} if gz.bytes_in else None
+                try:
+                    with s.get(url, stream=True, headers=headers) as r:
+                        r.raise_for_status()
+                        if gz.bytes_in and r.status_code != 206:
+                            # Ranges unsupported: start over with a clean decompressor and output file.
+                            gz = GunzipStream()
+                            f.seek(0)
+                            f.truncate()
+                        for chunk in r.iter_content(chunk_size=chunk_size):
+                            f.write(gz.feed(chunk))
+                    f.write(gz.flush())
+                    break
+                except Exception as e:
+                    if attempt >= retries or _is_client_error(e):
+                        raise
+                    attempt += 1
+                    _print(f"shard stream interrupted after {gz.bytes_in} bytes ({e}), resuming...")
+                    _backoff(attempt)
+        _save_members(out_path, gz)
+    except BaseException:
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        raise
+
+    _record("wat", gz.bytes_in, started, gz)
+    return gz.bytes_out
+
+
+# Inflates the (possibly multi-member) gzip file at `in_path` into `out_path`, returning the decompressed size.
+# A truncated file raises `EOFError` and the partial output is removed. The member index is written along with it.
+def gunzip_file(in_path: str, out_path: str, chunk_size: int = None) -> int:
+    chunk_size = chunk_size or CHUNK_SIZE
+    gz = GunzipStream()
+    _remove(out_path + MEMBERS_SUFFIX)
+
+    try:
+        with open(in_path, "rb") as f_in, open(out_path, "wb", buffering=chunk_size) as f_out:
+            while True:
+                chunk = f_in.read(chunk_size)
+                if not chunk:
+                    break
+                f_out.write(gz.feed(chunk))
+            f_out.write(gz.flush())
+        _save_members(out_path, gz)
+    except BaseException:
+        _remove(out_path)
+        raise
+
+    if metrics.active is not None:
+        metrics.active.inc("cah_gunzip_seconds_total", gz.seconds)
+    return gz.bytes_out
+
+
+# Downloads the gzipped shard at `url` and writes it decompressed to `out_path`.
+# With `segments` > 1 the compressed file is first fetched over parallel, resumable range requests
+# (kept next to `out_path` as `.gz` until inflated), otherwise it is inflated straight off a single stream.
+def fetch_shard(s, url: str, out_path: str, chunk_size: int = None, segments: int = 1) -> int:
+    _unshare(out_path)
+    if segments <= 1:
+        return stream_gunzip(s, url, out_path, chunk_size)
+
+    gz_path = out_path + ".gz"
+    started = monotonic()
+    _record("wat", range_download(s, url, gz_path, segments, chunk_size), started)
+    try:
+        return gunzip_file(gz_path, out_path, chunk_size)
+    finally:
+        _remove(gz_path)
+
+
+# Removes `path` if it is hardlinked elsewhere (e.g. delivered by `cache.ShardCache`), so writing a new shard over
+# it can't change the other copies.
+def _unshare(path: str) -> None:
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Downloads `url` into `out_path` over `segments` concurrent byte-range requests sharing the keep-alive pool of `s`.
+# Progress is checkpointed to `out_path + ".state"`, so calling this again after a crash resumes the partial file.
+# Falls back to a single (retried) stream when the server does not advertise range support.
+# Returns the size of the downloaded file.
+def range_download(s, url: str, out_path: str, segments: int = 4, chunk_size: int = None, retries: int = None) -> int:
+    chunk_size = chunk_size or CHUNK_SIZE
+    retries = RETRIES if retries is None else retries
+
+    size = _probe_ranges(s, url)
+    if size is None or segments <= 1:
+        return _single_download(s, url, out_path, chunk_size, retries)
+
+    state_path = out_path + ".state"
+    state = _load_state(state_path, url, size)
+    if state is None or not os.path.exists(out_path):
+        step = max(-(-size // segments), MIN_SEGMENT_SIZE)
+        state = {
+            "url": url,
+            "size": size,
+            "segments": [[start, min(start + step, size) - 1, 0] for start in range(0, size, step)]
+        }
+        with open(out_path, "wb") as f:
+            f.truncate(size)
+        _save_state(state_path, state)
+
+    lock = Lock()
+
+    def checkpoint() -> None:
+        with lock:
+            _save_state(state_path, state)
+
+    def fetch(segment: list) -> None:
+        start, end = segment[0], segment[1]
+        attempt = 0
+        with open(out_path, "r+b") as f:
+            while start + segment[2] <= end:
+                received = segment[2]
+                try:
+                    with s.get(url, stream=True, headers={"Range": f"bytes={start + received}-{end}"}) as r:
+                        r.raise_for_status()
+                        if r.status_code != 206:
+                            raise _RangeUnsupported()
+                        f.seek(start + received)
+                        for chunk in r.iter_content(chunk_size=chunk_size):
+                            chunk = chunk[:end + 1 - start - received]
+                            f.write(chunk)
+                            received += len(chunk)
+                    if start + received <= end:
+                        raise IOError(f"segment {start}-{end} ended early")
+                except _RangeUnsupported:
+                    raise
+                except Exception as e:
+                    if attempt >= retries or _is_client_error(e):
+                        raise
+                    attempt += 1
+                    _print(f"segment {start}-{end} interrupted ({e}), retrying...")
+                    _backoff(attempt)
+                finally:
+                    # Only checkpoint bytes that have actually reached the file.
+                    f.flush()
+                    segment[2] = received
+                    checkpoint()
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(state["segments"])) as pool:
+            for future in [pool.submit(fetch, segment) for segment in state["segments"]]:
+                future.result()
+    except _RangeUnsupported:
+        _remove(state_path)
+        return _single_download(s, url, out_path, chunk_size, retries)
+
+    _remove(state_path)
+    return size
+
+
+class _RangeUnsupported(Exception):
+    pass
+
+
+# Returns the content length of `url` if the server accepts byte ranges, otherwise None.
+def _probe_ranges(s, url: str) -> int:
+    try:
+        r = s.head(url, allow_redirects=True)
+        r.raise_for_status()
+    except Exception:
+        return None
+
+    if r.headers.get("Accept-Ranges", "").lower() != "bytes":
+        return None
+    try:
+        return int(r.headers["Content-Length"])
+    except (KeyError, ValueError):
+        return None
+
+
+# Plain single-connection download of `url` into `out_path`, restarted from scratch if the stream drops.
+def _single_download(s, url: str, out_path: str, chunk_size: int, retries: int) -> int:
+    attempt = 0
+    while True:
+        try:
+            written = 0
+            with s.get(url, stream=True) as r:
+                r.raise_for_status()
+                with open(out_path, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        written += len(chunk)
+            return written
+        except Exception as e:
+            if attempt >= retries or _is_client_error(e):
+                _remove(out_path)
+                raise
+            attempt += 1
+            _print(f"download interrupted ({e}), restarting...")
+            _backoff(attempt)
+
+
+def _load_state(state_path: str, url: str, size: int):
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if state.get("url") != url or state.get("size") != size:
+        return None
+    return state
+
+
+def _save_state(state_path: str, state: dict) -> None:
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def _remove(path: str) -> None:
+    if os.path.exists(path):
+        os.remove(path)
+
+
+# 4xx responses (bar 408/429) won't fix themselves, so they are not worth retrying.
+def _is_client_error(e: Exception) -> bool:
+    response = getattr(e, "response", None)
+    status = getattr(response, "status_code", None)
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+
+def _print(message) -> None:
+    from .core import print as cahprint
+    cahprint(message)
@@ -12,3 +12,9 @@ class InvalidURLError(Exception):
 
 class WorkerTimedOutError(Exception):
     pass
+
+class IncompleteArchiveError(IOError):
+    pass
+
+class UploadError(IOError):
+    pass
@@ -0,0 +1,143 @@
+from typing import Callable, Iterable, Iterator, List
+from urllib.parse import urljoin
+import numpy as np
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _json_loads
+
+    def _loads(data):
+        return _json_loads(bytes(data))
+
+# File extensions accepted by `extensions()` when no allowlist is given.
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp")
+
+# A filter receives a batch's `url` and `alt` columns and returns a boolean mask of the candidates to keep.
+Filter = Callable[[np.ndarray, np.ndarray], np.ndarray]
+
+
+# Keeps candidates whose alt text is at least `n` characters long (after stripping whitespace).
+def min_alt_length(n: int = 5) -> Filter:
+    def f(urls: np.ndarray, alts: np.ndarray) -> np.ndarray:
+        return np.fromiter((len(a) for a in alts), dtype=np.int64, count=len(alts)) >= n
+    return f
+
+
+# Keeps candidates whose URL path ends with one of `allow` (case-insensitive, query strings ignored).
+def extensions(allow=IMAGE_EXTENSIONS) -> Filter:
+    allow = tuple(e.lower() for e in allow)
+
+    def f(urls: np.ndarray, alts: np.ndarray) -> np.ndarray:
+        return np.fromiter((u.split("?", 1)[0].lower().endswith(allow) for u in urls), dtype=bool, count=len(urls))
+    return f
+
+
+DEFAULT_FILTERS = (min_alt_length(5),)
+
+
+# A columnar batch of image/alt-text candidates.
+# * `url`, `alt`, `page`: object arrays of the image URL, its alt text and the page it was found on
+# * `id`: int64 sample ids, assigned consecutively from the job's `start_id`
+class CandidateBatch:
+    __slots__ = ("url", "alt", "page", "id")
+
+    def __init__(self, url: np.ndarray, alt: np.ndarray, page: np.ndarray, id: np.ndarray) -> None:
+        self.url = url
+        self.alt = alt
+        self.page = page
+        self.id = id
+
+    def __len__(self) -> int:
+        return len(self.id)
+
+    def __repr__(self) -> str:
+        return f"<CandidateBatch {len(self)} candidates>"
+
+    # Returns the batch as a `pyarrow.RecordBatch` (requires `pyarrow`).
+    def to_arrow(self):
+        import pyarrow as pa
+        return pa.RecordBatch.from_arrays(
+            [pa.array(self.url, pa.string()), pa.array(self.alt, pa.string()),
+             pa.array(self.page, pa.string()), pa.array(self.id, pa.int64())],
+            names=["url", "alt", "page", "id"]
+        )
+
+
+# Appends the image url, alt text and page URL of every `<img>` with alt text in a WAT metadata record.
+def _candidates(payload, urls: List[str], alts: List[str], pages: List[str]) -> None:
+    try:
+        envelope = _loads(payload)["Envelope"]
+        page = envelope["WARC-Header-Metadata"]["WARC-Target-URI"]
+        links = envelope["Payload-Metadata"]["HTTP-Response-Metadata"]["HTML-Metadata"]["Links"]
+    except (KeyError, TypeError, ValueError):
+        return
+
+    for link in links:
+        if link.get("path") != "IMG@/src":
+            continue
+        alt = link.get("alt")
+        url = link.get("url")
+        if not alt or not url:
+            continue
+        alt = alt.strip()
+        if not url.startswith(("http://", "https://")):
+            url = urljoin(page, url)
+        urls.append(url)
+        alts.append(alt)
+        pages.append(page)
+
+
+# Extracts image/alt-text candidates from WAT `records` (see `wat.iter_records`) into `CandidateBatch`es of
+# up to `batch_size` candidates, after applying every filter in `filters`.
+# Sample ids are assigned consecutively from `start_id`; extraction stops once `end_id` is reached.
+# `dedup` (a `dedup.Deduplicator`) then drops candidates already seen, after every filter, only remembering the
+# candidates actually emitted.
+def extract(records: Iterable, start_id, end_id=None, filters: Iterable[Filter] = DEFAULT_FILTERS,
+            batch_size: int = 8192, dedup=None) -> Iterator[CandidateBatch]:
+    filters = tuple(filters)
+    next_id = np.int64(start_id)
+    urls, alts, pages = [], [], []
+
+    def flush():
+        nonlocal next_id, urls, alts, pages
+        url = np.array(urls, dtype=object)
+        alt = np.array(alts, dtype=object)
+        page = np.array(pages, dtype=object)
+        urls, alts, pages = [], [], []
+
+        keep = np.ones(len(url), dtype=bool)
+        for f in filters:
+            keep &= f(url, alt)
+        if not keep.all():
+            url, alt, page = url[keep], alt[keep], page[keep]
+
+        limit = None if end_id is None else max(0, int(end_id - next_id))
+        if dedup is not None:
+            selected = dedup.select(url, alt, limit)
+            url, alt, page = url[selected], alt[selected], page[selected]
+        elif limit is not None:
+            url, alt, page = url[:limit], alt[:limit], page[:limit]
+
+        n = len(url)
+
+        ids = next_id + np.arange(n, dtype=np.int64)
+        next_id += n
+        return CandidateBatch(url, alt, page, ids)
+
+    for record in records:
+        if record.headers.get("WARC-Type") != "metadata":
+            continue
+        _candidates(record.payload, urls, alts, pages)
+
+        if len(urls) >= batch_size:
+            batch = flush()
+            if len(batch):
+                yield batch
+            if end_id is not None and next_id >= end_id:
+                return
+
+    if urls:
+        batch = flush()
+        if len(batch):
+            yield batch
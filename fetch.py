@@ -0,0 +1,291 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import defaultdict, deque, Counter
+from urllib.parse import urlsplit
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable, Iterator
+import socket
+
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from .transport import TimeoutSession
+
+# Default (connect, read) timeout in seconds for each image.
+DEFAULT_TIMEOUT = (5, 10)
+
+# Images larger than this are abandoned (10 MiB).
+DEFAULT_MAX_SIZE = 10 << 20
+
+USER_AGENT = "crawlingathome-fetcher (+https://github.com/TheoCoombes/crawlingathome)"
+
+# Candidates read ahead per worker while waiting for hosts at their `per_host` limit, at most. Candidates for other
+# hosts are read past them, up to this bound on memory.
+MAX_BACKLOG = 64
+
+
+# Caches host name lookups for `ttl` seconds, and failed lookups for `negative_ttl` seconds, so tens of
+# thousands of image requests to a few thousand hosts don't each wait on the resolver.
+class DNSCache:
+    def __init__(self, ttl: float = 300.0, negative_ttl: float = 60.0) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = Lock()
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    # Returns every address `host` resolves to, in the resolver's order, raising `socket.gaierror` for (cached) failures.
+    def resolve(self, host: str, port: int) -> list:
+        now = monotonic()
+        with self._lock:
+            entry = self._cache.get(host)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                if isinstance(entry[0], Exception):
+                    raise entry[0]
+                return entry[0]
+            self.misses += 1
+
+        try:
+            addresses = list(dict.fromkeys(info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)))
+        except socket.gaierror as e:
+            with self._lock:
+                self._cache[host] = (e, now + self.negative_ttl)
+            raise
+
+        with self._lock:
+            self._cache[host] = (addresses, now + self.ttl)
+        return addresses
+
+
+# The DNS cache shared by every `ImageFetcher` in the process.
+dns_cache = DNSCache()
+
+
+class _CachedResolve:
+    # Connects to the cached addresses of the host in turn until one accepts, keeping the host name for the Host
+    # header and TLS.
+    def _new_conn(self):
+        host = self._dns_host
+        try:
+            addresses = dns_cache.resolve(host.rstrip("."), self.port)
+        except OSError:
+            return super()._new_conn()  # let urllib3 resolve it and raise its usual error
+
+        try:
+            for i, address in enumerate(addresses):
+                self._dns_host = address
+                try:
+                    return super()._new_conn()
+                except (NewConnectionError, ConnectTimeoutError):
+                    if i == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = host
+
+
+class _HTTPConnection(_CachedResolve, HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_CachedResolve, HTTPSConnection):
+    pass
+
+
+class _HTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+
+class _HTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+
+class _CachedDNSAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _HTTPConnectionPool, "https": _HTTPSConnectionPool}
+
+
+class _TooLarge(Exception):
+    pass
+
+
+# A fetched image.
+# * `url`, `alt`, `id`: the candidate's image URL, alt text and sample id
+# * `data`: the encoded image bytes, `image`: the output of the fetcher's `preprocess` (None without one)
+# * `error`: why the fetch failed (only set on failures, which are yielded with `yield_failures=True`)
+class FetchedImage:
+    __slots__ = ("url", "alt", "id", "data", "image", "error")
+
+    def __init__(self, url: str, alt: str, id, data: bytes = None, image=None, error: str = None) -> None:
+        self.url = url
+        self.alt = alt
+        self.id = id
+        self.data = data
+        self.image = image
+        self.error = error
+
+    def __repr__(self) -> str:
+        if self.error is not None:
+            return f"<FetchedImage {self.url} failed: {self.error}>"
+        return f"<FetchedImage {self.url} ({len(self.data)} bytes)>"
+
+
+# Fetches candidate images concurrently from a thread pool, yielding them as they arrive.
+# * `workers`: concurrent requests overall, `per_host`: concurrent requests per host
+# * `delay`: the minimum seconds between starting two requests to the same host
+# * `timeout`: the (connect, read) timeout of each request, `max_size`: the largest image accepted, in bytes
+# * `preprocess`: optionally decodes/resizes each image's bytes in the pool (e.g. `loader.pil_decoder(224)`);
+#   images it fails on count as failures
+# * `client`: reports progress through `client.log()` every `log_interval` seconds
+# Host names are resolved once through the shared `dns_cache`. Candidates for hosts at their `per_host` limit wait
+# without holding up the others, which are read past them (up to `MAX_BACKLOG` candidates per worker).
+class ImageFetcher:
+    def __init__(self, workers: int = 64, per_host: int = 4, delay: float = 0.0, timeout=DEFAULT_TIMEOUT,
+                 max_size: int = DEFAULT_MAX_SIZE, preprocess: Callable = None, client=None,
+                 log_interval: float = 30.0, session=None) -> None:
+        self.workers = workers
+        self.per_host = per_host
+        self.delay = delay
+        self.timeout = timeout
+        self.max_size = max_size
+        self.preprocess = preprocess
+        self.client = client
+        self.log_interval = log_interval
+        self.s = session or self._session()
+
+        self.fetched = 0
+        self.failed = 0
+        self.bytes = 0
+        self.errors = Counter()
+
+    def _session(self):
+        s = TimeoutSession(self.timeout)
+        adapter = _CachedDNSAdapter(pool_connections=max(16, self.workers), pool_maxsize=self.per_host)
+        s.mount("http://", adapter)
+        s.mount("https://", adapter)
+        s.headers["User-Agent"] = USER_AGENT
+        return s
+
+    # Fetches every candidate in `candidates`: a `CandidateBatch`, an iterable of them, or of (url, alt, id)
+    # tuples. Yields a `FetchedImage` per fetched image, in completion order.
+    def fetch(self, candidates, yield_failures: bool = False) -> Iterator[FetchedImage]:
+        queued = defaultdict(deque)  # host -> candidates waiting for a free slot
+        running = Counter()          # host -> requests in flight
+        next_start = {}              # host -> earliest start of the next request (politeness)
+        futures = {}
+        source = _candidates(candidates)
+        waiting = 0                  # candidates queued
+        exhausted = False
+        last_log = monotonic()
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cah-fetch") as pool:
+            while True:
+                # keep enough candidates queued that could start right away (i.e. within their host's free slots)
+                # to fill every worker, without reading the whole source
+                startable = sum(min(len(queue), self.per_host - running[host]) for host, queue in queued.items())
+                while not exhausted and startable < self.workers * 4 and waiting < self.workers * MAX_BACKLOG:
+                    try:
+                        candidate = next(source)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    host = _host(candidate[0])
+                    queued[host].append(candidate)
+                    waiting += 1
+                    if len(queued[host]) <= self.per_host - running[host]:
+                        startable += 1
+
+                now = monotonic()
+                wake = None
+                for host in list(queued):
+                    while queued[host] and len(futures) < self.workers and running[host] < self.per_host:
+                        if next_start.get(host, 0) > now:
+                            wake = min(wake or next_start[host], next_start[host])
+                            break
+                        candidate = queued[host].popleft()
+                        waiting -= 1
+                        running[host] += 1
+                        next_start[host] = now + self.delay
+                        futures[pool.submit(self._fetch, *candidate)] = host
+                    if not queued[host]:
+                        del queued[host]
+
+                if not futures:
+                    if waiting:
+                        sleep(max(0.0, (wake or now) - monotonic()))
+                        continue
+                    break
+
+                done, _ = wait(futures, timeout=None if wake is None else max(0.0, wake - monotonic()),
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    running[futures.pop(future)] -= 1
+                    result = future.result()
+                    if result.error is None:
+                        self.fetched += 1
+                        self.bytes += len(result.data)
+                        yield result
+                    else:
+                        self.failed += 1
+                        self.errors[result.error.split(":", 1)[0]] += 1
+                        if yield_failures:
+                            yield result
+
+                if self.client is not None and monotonic() - last_log >= self.log_interval:
+                    self._log()
+                    last_log = monotonic()
+
+        if self.client is not None:
+            self._log()
+
+    def _log(self) -> None:
+        self.client.log(f"Fetched {self.fetched} images ({self.failed} failed, {self.bytes / 1e6:.1f} MB)", noprint=True)
+
+    def _fetch(self, url: str, alt: str, id) -> FetchedImage:
+        try:
+            with self.s.get(url, stream=True) as r:
+                r.raise_for_status()
+                length = r.headers.get("Content-Length")
+                if length and length.isdigit() and int(length) > self.max_size:
+                    raise _TooLarge()
+
+                data = bytearray()
+                for chunk in r.iter_content(64 << 10):
+                    data += chunk
+                    if len(data) > self.max_size:
+                        raise _TooLarge()
+            data = bytes(data)
+        except _TooLarge:
+            return FetchedImage(url, alt, id, error=f"too large: over {self.max_size} bytes")
+        except Exception as e:
+            status = getattr(getattr(e, "response", None), "status_code", None)
+            return FetchedImage(url, alt, id, error=f"status {status}" if status else f"{type(e).__name__}: {e}")
+
+        image = None
+        if self.preprocess is not None:
+            try:
+                image = self.preprocess(data)
+            except Exception as e:
+                return FetchedImage(url, alt, id, error=f"undecodable: {e}")
+        return FetchedImage(url, alt, id, data, image)
+
+
+def _host(url: str) -> str:
+    try:
+        return urlsplit(url).netloc.lower()
+    except ValueError:
+        return ""
+
+
+def _candidates(candidates) -> Iterator[tuple]:
+    if hasattr(candidates, "url") and hasattr(candidates, "alt"):
+        candidates = (candidates,)
+    for item in candidates:
+        if hasattr(item, "url") and hasattr(item, "alt"):
+            yield from zip(item.url, item.alt, item.id)
+        else:
+            yield tuple(item)
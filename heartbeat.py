@@ -0,0 +1,84 @@
+from threading import Thread, Event, current_thread
+from typing import Callable
+
+from .retry import RetryPolicy
+
+# Response header through which the server may change the heartbeat interval (in seconds).
+INTERVAL_HEADER = "X-Heartbeat-Interval"
+
+
+# Keeps a client's worker registration alive from a background thread by calling `api/validateWorker`
+# every `interval` seconds over the client's pooled session, so the worker loop can check the local
+# `alive` flag instead of making a request each iteration. The registration checked is the one holding the
+# current job; those holding queued jobs (see `newJobs()`) are kept alive along with it.
+# Once the server reports the worker as gone, `alive` becomes False, `evicted` is set, `on_evicted(client)`
+# is called (from the heartbeat thread) and the heartbeat stops. Network errors are not treated as eviction.
+class Heartbeat:
+    def __init__(self, client, interval: float = 60.0, on_evicted: Callable = None) -> None:
+        self.client = client
+        self.interval = interval
+        self.on_evicted = on_evicted
+        self.policy = RetryPolicy(max_attempts=3, deadline=interval, max_delay=interval / 4)
+
+        self.alive = True
+        self.evicted = Event()
+        self.beats = 0
+        self._stop = Event()
+
+        self._thread = Thread(target=self._run, name="cah-heartbeat", daemon=True)
+        self._thread.start()
+
+    # Stops the heartbeat thread. Safe to call from `on_evicted`.
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not current_thread():
+            self._thread.join()
+
+    # Checks the registration once, returning whether the worker is still alive (None if the server couldn't be reached).
+    def beat(self) -> bool:
+        from .core import _safe_request
+
+        client = self.client
+        url = client._urls["api/validateWorker"]
+        try:
+            r = _safe_request(client.s.post, url, policy=self.policy, json=client._jobAuth)
+        except Exception:
+            return None
+
+        for auth in client._queuedAuths():
+            try:
+                _safe_request(client.s.post, url, policy=self.policy, json=auth)
+            except Exception:
+                pass
+
+        self.beats += 1
+        self._follow(r.headers.get(INTERVAL_HEADER))
+
+        if r.status_code == 404:  # `WorkerTimedOutError`
+            return False
+        if r.status_code != 200:
+            return None
+        return "True" in r.text
+
+    def _follow(self, interval) -> None:
+        try:
+            interval = float(interval)
+        except (TypeError, ValueError):
+            return
+        if interval > 0:
+            self.interval = interval
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            if self.beat() is not False:
+                continue
+
+            self.alive = False
+            self.evicted.set()
+            if self.on_evicted is not None:
+                try:
+                    self.on_evicted(self.client)
+                except Exception as e:
+                    from .core import print
+                    print(f"heartbeat eviction callback failed: {e}")
+            return
@@ -0,0 +1,36 @@
+_int64 = None
+
+
+# Converts a sample id to `np.int64`, or to a plain int when numpy isn't installed.
+# numpy is only imported once the first id is converted, keeping it out of `import crawlingathome`.
+def as_id(value):
+    global _int64
+    if _int64 is None:
+        try:
+            from numpy import int64 as _int64
+        except ImportError:
+            _int64 = int
+    return _int64(value)
+
+
+# A leased job.
+# * `shard`, `start_id`, `end_id`, `shard_piece`: as on the client (see README)
+# * `token`: the token of the worker registration that leased the job, which must be used to complete it
+class Job:
+    __slots__ = ("shard", "start_id", "end_id", "shard_piece", "token", "_owner")
+
+    def __init__(self, shard: str, start_id, end_id, shard_piece: int, token: str, _owner=None) -> None:
+        self.shard = shard
+        self.start_id = as_id(start_id)
+        self.end_id = as_id(end_id)
+        self.shard_piece = shard_piece
+        self.token = token
+        self._owner = _owner
+
+    # Creates a job from an `api/newJob` response entry.
+    @classmethod
+    def fromResponse(cls, data: dict, token: str, _owner=None) -> "Job":
+        return cls(data["url"], data["start_id"], data["end_id"], data["shard"], token, _owner)
+
+    def __repr__(self) -> str:
+        return f"<Job {self.shard} piece {self.shard_piece} ids {self.start_id}-{self.end_id}>"
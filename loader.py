@@ -0,0 +1,253 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Thread, Event
+from queue import Queue, Full
+from collections import deque
+from typing import Callable, Iterator
+import numpy as np
+import tarfile
+import csv
+import io
+import os
+
+# File extensions treated as images.
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp")
+
+# Default metadata columns holding each image's sample id and alt text.
+ID_COLUMN = "SAMPLE_ID"
+TEXT_COLUMN = "TEXT"
+
+# Prefix of the PAX header records holding an image's metadata columns in archives from `archive.ArchiveWriter`.
+PAX_PREFIX = "CAH."
+
+
+# Returns a decoder that turns encoded image bytes into an RGB `uint8` array of `size` x `size` (requires `Pillow`).
+# This is the default `preprocess` of `ImageLoader`; pass your own callable for model-specific transforms.
+def pil_decoder(size: int = 224) -> Callable[[bytes], np.ndarray]:
+    import PIL.Image  # fail early if Pillow isn't installed
+    return _PILDecoder(size)
+
+
+class _PILDecoder:
+    def __init__(self, size: int) -> None:
+        self.size = size
+
+    def __call__(self, data: bytes) -> np.ndarray:
+        from PIL import Image
+        with Image.open(io.BytesIO(data)) as im:
+            im.draft("RGB", (self.size, self.size))  # lets JPEG decode at reduced scale
+            return np.asarray(im.convert("RGB").resize((self.size, self.size)), dtype=np.uint8)
+
+
+# A batch of decoded images with their metadata.
+# * `images`: the decoded images, stacked into one array when they share a shape, otherwise a list
+# * `ids`: int64 sample ids (-1 where unknown), `texts`: alt texts, `names`: file names within the shard
+class ImageBatch:
+    __slots__ = ("images", "ids", "texts", "names")
+
+    def __init__(self, images, ids: np.ndarray, texts: list, names: list) -> None:
+        self.images = images
+        self.ids = ids
+        self.texts = texts
+        self.names = names
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __repr__(self) -> str:
+        return f"<ImageBatch {len(self)} images>"
+
+
+# Reads a metadata CSV into {file stem: (sample id, alt text)}.
+def read_metadata(f, id_column: str = ID_COLUMN, text_column: str = TEXT_COLUMN) -> dict:
+    if isinstance(f, (bytes, bytearray)):
+        f = io.StringIO(f.decode("utf-8", "replace"))
+    elif isinstance(f, str):
+        with open(f, newline="", encoding="utf-8", errors="replace") as fp:
+            return read_metadata(fp, id_column, text_column)
+
+    metadata = {}
+    for row in csv.DictReader(f):
+        sample_id = row.get(id_column)
+        if sample_id is None:
+            continue
+        sample_id = sample_id.strip()
+        try:
+            metadata[sample_id] = (int(sample_id), row.get(text_column) or "")
+        except ValueError:
+            continue
+    return metadata
+
+
+def _stem(name: str) -> str:
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+def _is_image(name: str) -> bool:
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+# Decodes `data` with `preprocess`, returning None for images that fail to decode.
+def _decode(preprocess, data: bytes):
+    try:
+        return preprocess(data)
+    except Exception:
+        return None
+
+
+# Feeds fixed-size batches of decoded images from a GPU job's shard, decoding in a thread (or process) pool
+# while the previous batches are consumed. `source` is the extracted directory, or a tar(.gz) file path or
+# file object, which is read as a stream without extracting it.
+# Each image's sample id and alt text come from the shard's metadata CSV (matched by file stem). In a tar stream,
+# where the CSV may only come at the end, they are read from the image's PAX header records (`CAH.SAMPLE_ID`,
+# `CAH.TEXT`) instead, and failing that, numeric file stems are used as sample ids.
+class ImageLoader:
+    def __init__(self, source, batch_size: int = 256, preprocess: Callable[[bytes], np.ndarray] = None,
+                 workers: int = None, prefetch: int = 4, metadata=None, use_processes: bool = False,
+                 drop_last: bool = False) -> None:
+        self.source = source
+        self.batch_size = batch_size
+        self.preprocess = preprocess or pil_decoder()
+        self.workers = workers or os.cpu_count()
+        self.prefetch = prefetch
+        self.metadata = metadata if isinstance(metadata, dict) or metadata is None else read_metadata(metadata)
+        self.use_processes = use_processes
+        self.drop_last = drop_last
+        self.failed = 0
+        self._headers = {}   # file stem -> (sample id, alt text) from PAX headers
+
+    def __iter__(self) -> Iterator[ImageBatch]:
+        batches = Queue(maxsize=self.prefetch)
+        stop = Event()
+        done = object()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def produce() -> None:
+            try:
+                for batch in self._batches(stop):
+                    if not put(batch):
+                        return
+                put(done)
+            except BaseException as e:
+                put(e)
+
+        thread = Thread(target=produce, name="cah-loader", daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is done:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    # Yields (name, encoded bytes) for every image in the source, reading metadata as it is found.
+    def _files(self) -> Iterator[tuple]:
+        if isinstance(self.source, str) and os.path.isdir(self.source):
+            names = []
+            for root, _, files in os.walk(self.source):
+                for name in files:
+                    full = os.path.join(root, name)
+                    if name.lower().endswith(".csv") and self.metadata is None:
+                        self.metadata = read_metadata(full)
+                    elif _is_image(name):
+                        names.append(full)
+            for full in sorted(names):
+                with open(full, "rb") as f:
+                    yield os.path.relpath(full, self.source), f.read()
+            return
+
+        if isinstance(self.source, str):
+            tar = tarfile.open(self.source, mode="r|*")
+        else:
+            tar = tarfile.open(fileobj=self.source, mode="r|*")
+        with tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                if member.name.lower().endswith(".csv") and self.metadata is None:
+                    self.metadata = read_metadata(tar.extractfile(member).read())
+                elif _is_image(member.name):
+                    self._header(member)
+                    yield member.name, tar.extractfile(member).read()
+
+    # Records the metadata carried in `member`'s PAX header records, if any.
+    def _header(self, member) -> None:
+        sample_id = member.pax_headers.get(PAX_PREFIX + ID_COLUMN)
+        if sample_id is None:
+            return
+        try:
+            self._headers[_stem(member.name)] = (int(sample_id), member.pax_headers.get(PAX_PREFIX + TEXT_COLUMN) or "")
+        except ValueError:
+            pass
+
+    def _lookup(self, name: str) -> tuple:
+        stem = _stem(name)
+        if self.metadata and stem in self.metadata:
+            return self.metadata[stem]
+        if stem in self._headers:
+            return self._headers.pop(stem)
+        return (int(stem) if stem.isdigit() else -1), ""
+
+    def _batches(self, stop: Event) -> Iterator[ImageBatch]:
+        Executor = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        pending = deque()
+        ready = []
+        window = self.batch_size * (self.prefetch + 1)
+
+        with Executor(max_workers=self.workers) as pool:
+            def collect(block: bool):
+                while pending and (block or pending[0][1].done()):
+                    name, future = pending.popleft()
+                    image = future.result()
+                    if image is None:
+                        self.failed += 1
+                    else:
+                        ready.append((name, image))
+                    if len(ready) >= self.batch_size:
+                        return
+
+            for name, data in self._files():
+                if stop.is_set():
+                    return
+                pending.append((name, pool.submit(_decode, self.preprocess, data)))
+
+                collect(block=len(pending) >= window)
+                while len(ready) >= self.batch_size:
+                    yield self._assemble(ready[:self.batch_size])
+                    del ready[:self.batch_size]
+                    collect(block=False)
+
+            while pending or len(ready) >= self.batch_size:
+                collect(block=True)
+                while len(ready) >= self.batch_size:
+                    yield self._assemble(ready[:self.batch_size])
+                    del ready[:self.batch_size]
+
+        if ready and not self.drop_last:
+            yield self._assemble(ready)
+
+    def _assemble(self, items: list) -> ImageBatch:
+        names = [name for name, _ in items]
+        images = [image for _, image in items]
+        meta = [self._lookup(name) for name in names]
+
+        if all(getattr(image, "shape", None) == getattr(images[0], "shape", None) for image in images):
+            images = np.stack(images)
+        return ImageBatch(
+            images,
+            np.fromiter((m[0] for m in meta), dtype=np.int64, count=len(meta)),
+            [m[1] for m in meta],
+            names
+        )
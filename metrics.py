@@ -0,0 +1,184 @@
+from threading import Lock
+from bisect import bisect_left
+
+# The sink receiving metrics, or None while metrics are disabled (the default). Instrumented code checks this
+# before doing any work, so disabled metrics cost one attribute lookup per call site.
+active = None
+
+# Upper bounds (in seconds) of the histogram buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# Descriptions of the metrics reported by the clients.
+HELP = {
+    "cah_request_seconds": "Latency of tracker requests, including retries, by endpoint and final status.",
+    "cah_request_retries_total": "Tracker request retries by endpoint and reason (error or status code).",
+    "cah_download_bytes_total": "Compressed bytes downloaded by kind (wat or archive).",
+    "cah_download_seconds": "Duration of shard downloads by kind, including decompression while streaming.",
+    "cah_gunzip_seconds_total": "Time spent decompressing WATs.",
+    "cah_job_seconds": "Time from leasing a job to marking it as done, by client type.",
+    "cah_prefetch_queue_depth": "Prefetched jobs ready to be handed over.",
+    "cah_progress_pending": "Progress updates waiting to be sent by background loggers.",
+    "cah_progress_coalesced_total": "Progress updates overwritten before they were sent.",
+    "cah_cache_requests_total": "Shard cache lookups by result (hit or miss).",
+    "cah_upload_bytes_total": "Result bytes uploaded to upload servers.",
+    "cah_upload_failovers_total": "Uploads moved to a new upload server after repeated failures.",
+}
+
+
+def _key(labels) -> tuple:
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _format(name: str, labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Collects counters, histograms and gauges in memory and renders them in the Prometheus text format.
+# Any object with the same `inc`, `observe`, `track` and `untrack` methods can be used as a sink instead,
+# e.g. to forward metrics to StatsD.
+class Registry:
+    def __init__(self, buckets=DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self._lock = Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    # Adds `value` to a counter.
+    def inc(self, name: str, value=1, labels: dict = None) -> None:
+        key = (name, _key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    # Records `value` in a histogram.
+    def observe(self, name: str, value: float, labels: dict = None) -> None:
+        key = (name, _key(labels))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            h[0][bisect_left(self.buckets, value)] += 1
+            h[1] += value
+
+    # Reports the value returned by `fn()` as a gauge at collection time. Values of every function tracked
+    # under the same name and labels are summed.
+    def track(self, name: str, fn, labels: dict = None) -> None:
+        with self._lock:
+            self._gauges.setdefault((name, _key(labels)), []).append(fn)
+
+    def untrack(self, name: str, fn, labels: dict = None) -> None:
+        with self._lock:
+            fns = self._gauges.get((name, _key(labels)), [])
+            if fn in fns:
+                fns.remove(fn)
+
+    # Returns every metric in the Prometheus text exposition format.
+    def render(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h[0]), h[1]) for key, h in self._histograms.items()}
+            gauges = {key: list(fns) for key, fns in self._gauges.items()}
+
+        families = {}
+        for (name, labels), value in counters.items():
+            families.setdefault((name, "counter"), []).append(f"{_format(name, labels)} {_number(value)}")
+
+        for (name, labels), (counts, total) in histograms.items():
+            lines = families.setdefault((name, "histogram"), [])
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{_format(name + '_bucket', labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{_format(name + '_sum', labels)} {_number(total)}")
+            lines.append(f"{_format(name + '_count', labels)} {cumulative}")
+
+        for (name, labels), fns in gauges.items():
+            value = 0
+            for fn in fns:
+                try:
+                    value += fn()
+                except Exception:
+                    pass
+            families.setdefault((name, "gauge"), []).append(f"{_format(name, labels)} {_number(value)}")
+
+        out = []
+        for (name, kind), lines in sorted(families.items()):
+            if name in HELP:
+                out.append(f"# HELP {name} {HELP[name]}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+
+_server = None
+
+
+# Enables metrics, returning the sink. With `port`, they are also served at `http://<addr>:<port>/metrics`
+# (port 0 picks a free port, see `server_port`). `sink` defaults to a new `Registry`.
+def enable(port: int = None, addr: str = "127.0.0.1", sink=None):
+    global active, _server
+
+    disable()
+    active = sink if sink is not None else Registry()
+
+    if port is not None:
+        _server = _serve(active, addr, port)
+    return active
+
+
+# Disables metrics and stops the `/metrics` server.
+def disable() -> None:
+    global active, _server
+
+    active = None
+    if _server is not None:
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+
+
+# The port the `/metrics` server listens on, or None.
+def server_port():
+    return _server.server_port if _server is not None else None
+
+
+def _serve(registry, addr: str, port: int):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from threading import Thread
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="cah-metrics", daemon=True).start()
+    return server
+
+
+# The tracker endpoint `url` points to (e.g. "api/newJob"), used as the `endpoint` label.
+def endpoint(url: str) -> str:
+    parts = url.split("?", 1)[0].rstrip("/").rsplit("/", 2)
+    return "/".join(parts[-2:]) if len(parts) >= 2 else url
@@ -0,0 +1,363 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from threading import Thread, Lock
+from collections import deque, Counter
+from time import sleep
+import itertools
+import hashlib
+import tarfile
+import random
+import json
+import gzip
+import io
+import os
+
+# The endpoints served by `MockTracker` (besides the synthetic files under `files/`).
+ENDPOINTS = (
+    "api/new", "api/getUploadAddress", "api/jobCount", "api/newJob", "api/markAsDone", "api/updateProgress",
+    "api/validateWorker", "api/bye", "api/gpuInvalidDownload",
+    "custom/get-cpu-wat", "custom/lookup-wat", "custom/markasdone-cpu"
+)
+
+
+# Builds a synthetic WAT of `records` metadata records, each linking `images` images with alt text.
+# Every record is its own gzip member, like CommonCrawl's WATs. Returns (decompressed, compressed) bytes.
+def synthetic_wat(records: int = 100, images: int = 3) -> tuple:
+    raw, compressed = [], []
+    for i in range(-1, records):
+        kind = "warcinfo" if i < 0 else "metadata"
+        page = f"http://site{i}.example/page"
+        payload = json.dumps({"Envelope": {
+            "WARC-Header-Metadata": {"WARC-Target-URI": page},
+            "Payload-Metadata": {"HTTP-Response-Metadata": {"HTML-Metadata": {"Links": [
+                {"path": "IMG@/src", "url": f"/img{i}_{k}.jpg", "alt": f"synthetic image {k} of page {i}"}
+                for k in range(images)
+            ]}}}
+        }}).encode()
+        record = (
+            f"WARC/1.0\r\nWARC-Type: {kind}\r\nWARC-Target-URI: {page}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n"
+        ).encode() + payload + b"\r\n\r\n"
+        raw.append(record)
+        compressed.append(gzip.compress(record, compresslevel=1))
+    return b"".join(raw), b"".join(compressed)
+
+
+# Builds a synthetic GPU job archive: `images` random "images" of `size` bytes and a metadata CSV (.tar.gz bytes).
+def synthetic_archive(images: int = 16, size: int = 4096) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz", compresslevel=1) as tar:
+        def add(name: str, data: bytes) -> None:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+        rows = ["SAMPLE_ID,URL,TEXT"]
+        for i in range(images):
+            add(f"{i}.jpg", os.urandom(size))
+            rows.append(f"{i},http://site{i}.example/img{i}.jpg,synthetic image {i}")
+        add("images.csv", "\n".join(rows).encode())
+    return buf.getvalue()
+
+
+# An in-process stand-in for the crawling@home tracker, serving every endpoint the clients call plus
+# synthetic WATs (`files/shard-<n>.wat.gz`, with HEAD and Range support) and GPU job archives
+# (`files/images-<n>.tar.gz`) from a local HTTP server. It is also the workers' upload server (`upload/`, see
+# `upload.Uploader`), serving committed uploads from `files/uploads/<name>`.
+# * `jobs`: the amount of jobs handed out before `api/newJob` answers 403, or None for no limit
+# * `latency`: seconds added to every tracker request, or a function of the endpoint returning them
+# * `error_rate`: the fraction of tracker requests answered with a random 5xx status
+# * `multi`: whether `api/newJob` honours `count` by returning a list of jobs
+# * `records`: the amount of records in each synthetic WAT
+# Use `fail()` to queue specific statuses (e.g. 403/404) for an endpoint (`upload` for the upload server) and
+# `expire()` to time a worker out. `upload_address` is what `api/getUploadAddress` hands out.
+class MockTracker:
+    def __init__(self, jobs: int = None, latency=0.0, error_rate: float = 0.0, multi: bool = False,
+                 records: int = 100, images: int = 16, host: str = "127.0.0.1", port: int = 0, seed: int = None) -> None:
+        self.jobs = jobs
+        self.latency = latency
+        self.error_rate = error_rate
+        self.multi = multi
+
+        self.workers = {}
+        self.open = {}
+        self.completed = []
+        self.progress = {}
+        self.calls = Counter()
+        self.uploads = {}
+
+        self._lock = Lock()
+        self._rng = random.Random(seed)
+        self._ids = itertools.count()
+        self._faults = {}
+        self._gpu = deque()
+        self._wat = synthetic_wat(records)[1]
+        self._archive = synthetic_archive(images)
+
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+        self.url = f"http://{host}:{self._server.server_port}/"
+        self.upload_address = f"{self.url}upload/"
+
+    def start(self) -> "MockTracker":
+        self._thread = Thread(target=self._server.serve_forever, name="cah-mock-tracker", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self) -> "MockTracker":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    # Answers the next `times` requests to `endpoint` with `status` (and `text`).
+    def fail(self, endpoint: str, status: int, times: int = 1, text: str = "injected failure") -> None:
+        with self._lock:
+            self._faults.setdefault(endpoint, deque()).extend([(status, text)] * times)
+
+    # Drops the worker registered with `token`, as the tracker does once a worker times out.
+    def expire(self, token: str) -> None:
+        with self._lock:
+            self.workers.pop(token, None)
+            self.open.pop(token, None)
+
+    # Returns (status, body, headers) for a request.
+    def _handle(self, method: str, path: str, query: dict, body: bytes, headers) -> tuple:
+        endpoint = path.strip("/")
+        if endpoint.startswith("files/"):
+            return self._file(method, endpoint, headers)
+        if endpoint.startswith("upload/"):
+            with self._lock:
+                self.calls["upload"] += 1
+                faults = self._faults.get("upload")
+                if faults:
+                    status, text = faults.popleft()
+                    return status, text.encode(), {}
+                return self._upload(method, endpoint[len("upload/"):], query, body, headers)
+        if endpoint not in ENDPOINTS:
+            return 404, b"not found", {}
+
+        self.calls[endpoint] += 1
+        delay = self.latency(endpoint) if callable(self.latency) else self.latency
+        if delay:
+            sleep(delay)
+
+        with self._lock:
+            faults = self._faults.get(endpoint)
+            if faults:
+                status, text = faults.popleft()
+                return status, text.encode(), {}
+            if self.error_rate and self._rng.random() < self.error_rate:
+                return self._rng.choice((500, 502, 503, 504)), b"injected server error", {}
+
+            data = {k: v[0] for k, v in query.items()}
+            if body:
+                try:
+                    data.update(json.loads(body))
+                except ValueError:
+                    return 400, b"invalid json", {}
+            return getattr(self, "_" + endpoint.replace("/", "_").replace("-", "_"))(data)
+
+    def _json(self, value) -> tuple:
+        return 200, json.dumps(value).encode(), {"Content-Type": "application/json"}
+
+    def _text(self, value) -> tuple:
+        return 200, str(value).encode(), {}
+
+    def _worker(self, data: dict):
+        return self.workers.get(data.get("token"))
+
+    def _lease(self, kind: str) -> dict:
+        n = next(self._ids)
+        if kind == "GPU":
+            url = self._gpu.popleft() if self._gpu else f"{self.url}files/images-{n}.tar.gz"
+        else:
+            url = f"{self.url}files/shard-{n}.wat.gz"
+        if self.jobs is not None:
+            self.jobs -= 1
+        return {"url": url, "start_id": n * 1_000_000, "end_id": (n + 1) * 1_000_000, "shard": n % 2}
+
+    def _api_new(self, data: dict) -> tuple:
+        n = next(self._ids)
+        token = f"token-{n}"
+        self.workers[token] = {"type": data.get("type", "HYBRID"), "nickname": data.get("nickname"), "name": f"worker-{n}"}
+        return self._json({"token": token, "display_name": f"worker-{n}", "upload_address": self.upload_address})
+
+    def _api_getUploadAddress(self, data: dict) -> tuple:
+        return self._text(self.upload_address)
+
+    def _api_jobCount(self, data: dict) -> tuple:
+        return self._text(10 ** 6 if self.jobs is None else self.jobs)
+
+    def _api_newJob(self, data: dict) -> tuple:
+        worker = self._worker(data)
+        if worker is None:
+            return 404, b"worker not found", {}
+        if self.jobs is not None and self.jobs <= 0:
+            return 403, b"no jobs available", {}
+
+        if self.multi and data.get("count"):
+            count = int(data["count"]) if self.jobs is None else min(int(data["count"]), self.jobs)
+            jobs = [self._lease(worker["type"]) for _ in range(count)]
+            self.open[data["token"]] = jobs
+            return self._json(jobs)
+
+        job = self._lease(worker["type"])
+        self.open[data["token"]] = [job]
+        return self._json(job)
+
+    def _api_markAsDone(self, data: dict) -> tuple:
+        if self._worker(data) is None or data["token"] not in self.open:
+            return 404, b"worker not found", {}
+        jobs = self.open[data["token"]]
+        if "jobs" in data or "job" in data:
+            named = [entry.get("job") or {} for entry in data["jobs"]] if "jobs" in data else [data["job"]]
+            done = [job for job in jobs if any(job["url"] == n.get("url") and job["shard"] == n.get("shard") for n in named)]
+        else:
+            done = list(jobs)
+        for job in done:
+            jobs.remove(job)
+        if not jobs:
+            del self.open[data["token"]]
+        self.completed.extend(done)
+        url = data.get("url")
+        if isinstance(url, str) and url.startswith(("http", "file://")):
+            self._gpu.append(url)
+        return self._text("success")
+
+    def _api_updateProgress(self, data: dict) -> tuple:
+        if self._worker(data) is None:
+            return 404, b"worker not found", {}
+        self.progress[data["token"]] = data.get("progress")
+        return self._text("success")
+
+    def _api_validateWorker(self, data: dict) -> tuple:
+        return self._text(self._worker(data) is not None)
+
+    def _api_bye(self, data: dict) -> tuple:
+        self.workers.pop(data.get("token"), None)
+        self.open.pop(data.get("token"), None)
+        return self._text("success")
+
+    def _api_gpuInvalidDownload(self, data: dict) -> tuple:
+        self.open.pop(data.get("token"), None)
+        return self._text("success")
+
+    def _custom_get_cpu_wat(self, data: dict) -> tuple:
+        if self.jobs is not None and self.jobs <= 0:
+            return self._text("no jobs")
+        return self._text(self._lease("CPU")["url"])
+
+    def _custom_lookup_wat(self, data: dict) -> tuple:
+        n = next(self._ids)
+        return self._json({"status": "success", "shards": [
+            [2 * n, {"url": data.get("url"), "start_id": 2 * n * 1_000_000, "end_id": (2 * n + 1) * 1_000_000, "shard": 0}],
+            [2 * n + 1, {"url": data.get("url"), "start_id": (2 * n + 1) * 1_000_000, "end_id": (2 * n + 2) * 1_000_000, "shard": 1}]
+        ]})
+
+    def _custom_markasdone_cpu(self, data: dict) -> tuple:
+        shards = data.get("shards") or []
+        self.completed.extend(shards)
+        return self._json({"status": "success", "completed": len(shards)})
+
+    # The chunked upload protocol of `upload.Uploader`: GET lists stored chunks, PUT stores one, POST commits.
+    def _upload(self, method: str, name: str, query: dict, body: bytes, headers) -> tuple:
+        upload = self.uploads.setdefault(name, {"chunks": {}, "data": None})
+
+        if method == "GET":
+            if not upload["chunks"]:
+                return 404, b"unknown upload", {}
+            return self._json({"chunks": {str(i): hashlib.sha256(c).hexdigest() for i, c in upload["chunks"].items()}})
+
+        if method == "PUT":
+            if hashlib.sha256(body).hexdigest() != headers.get("X-Chunk-SHA256"):
+                return 422, b"chunk digest mismatch", {}
+            upload["chunks"][int(query["chunk"][0])] = body
+            return self._text("success")
+
+        if method == "POST":
+            meta = json.loads(body)
+            chunks = upload["chunks"]
+            if any(i not in chunks for i in range(meta["chunks"])):
+                return 400, b"missing chunks", {}
+            data = b"".join(chunks[i] for i in range(meta["chunks"]))
+            if len(data) != meta["size"] or hashlib.sha256(data).hexdigest() != meta["sha256"]:
+                upload["chunks"].clear()
+                return 422, b"upload digest mismatch", {}
+            upload["data"] = data
+            return self._json({"url": f"{self.url}files/uploads/{name}"})
+
+        return 405, b"method not allowed", {}
+
+    def _file(self, method: str, endpoint: str, headers) -> tuple:
+        if endpoint.startswith("files/uploads/"):
+            upload = self.uploads.get(endpoint[len("files/uploads/"):])
+            if upload is None or upload["data"] is None:
+                return 404, b"not found", {}
+            data = upload["data"]
+        elif endpoint.endswith(".wat.gz"):
+            data = self._wat
+        elif endpoint.endswith(".tar.gz"):
+            data = self._archive
+        else:
+            return 404, b"not found", {}
+
+        status, extra = 200, {"Accept-Ranges": "bytes"}
+        ranged = headers.get("Range")
+        if ranged and ranged.startswith("bytes="):
+            first, _, last = ranged[len("bytes="):].partition("-")
+            first = int(first)
+            last = min(int(last) if last else len(data) - 1, len(data) - 1)
+            if first >= len(data):
+                return 416, b"", {"Content-Range": f"bytes */{len(data)}"}
+            extra["Content-Range"] = f"bytes {first}-{last}/{len(data)}"
+            data, status = data[first:last + 1], 206
+
+        if method == "HEAD":
+            extra["Content-Length"] = str(len(data))
+            return status, b"", extra
+        return status, data, extra
+
+
+def _handler(tracker: MockTracker):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _serve(self, method: str) -> None:
+            parts = urlsplit(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+
+            status, data, headers = tracker._handle(method, parts.path, parse_qs(parts.query), body, self.headers)
+
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            if "Content-Length" not in headers:
+                self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            if method != "HEAD":
+                self.wfile.write(data)
+
+        def do_GET(self) -> None:
+            self._serve("GET")
+
+        def do_POST(self) -> None:
+            self._serve("POST")
+
+        def do_PUT(self) -> None:
+            self._serve("PUT")
+
+        def do_HEAD(self) -> None:
+            self._serve("HEAD")
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+    return Handler
@@ -0,0 +1,182 @@
+from threading import Thread, Event, Lock
+from time import monotonic
+from queue import Queue, Empty, Full
+import shutil
+import os
+
+from .errors import ZeroJobError, WorkerTimedOutError
+from . import metrics
+
+# Attributes that make up a leased job along with the worker registration that owns it (including the files
+# extracted by `GPUClient.downloadShard()` and the job's trace timeline).
+_FIELDS = ("token", "display_name", "upload_address", "shard", "start_id", "end_id", "shard_piece", "members", "_trace")
+
+
+# Leases and downloads up to `depth` jobs ahead of a client in a background thread.
+# Each prefetched job is leased through its own sibling worker registration, so the tracker never sees more than
+# one open job per token. Handing a job over swaps the client's registration with the sibling's, and the
+# client's old (finished) registration is reused for the next lease.
+# Once the server has no jobs, `newJob()` raises `ZeroJobError` as usual, and the server is asked again at most
+# every `retry_delay` seconds.
+class Prefetcher:
+    def __init__(self, client, depth: int = 1, path: str = "", chunk_size: int = None,
+                 segments: int = 1, retry_delay: int = 30) -> None:
+        self.client = client
+        self.depth = max(1, depth)
+        self.path = path
+        self.chunk_size = chunk_size
+        self.segments = segments
+        self.retry_delay = retry_delay
+
+        self._idle = Queue()
+        self._ready = Queue(maxsize=self.depth)
+        self._lock = Lock()
+        self._stop = Event()
+        self._installed = False
+        self._counter = 0
+        self._error = None
+        self._empty_until = 0.0   # no jobs were available until then
+
+        for _ in range(self.depth):
+            self._idle.put(None)
+
+        self._sink = metrics.active
+        if self._sink is not None:
+            self._sink.track("cah_prefetch_queue_depth", self.qsize)
+
+        self._thread = Thread(target=self._run, name="cah-prefetch", daemon=True)
+        self._thread.start()
+
+    # The amount of downloaded jobs waiting to be handed over.
+    def qsize(self) -> int:
+        return self._ready.qsize()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                slot = self._idle.get(timeout=1)
+            except Empty:
+                continue
+
+            item = self._prefetch(slot)
+            while not self._stop.is_set():
+                try:
+                    self._ready.put(item, timeout=1)
+                    break
+                except Full:
+                    continue
+            else:
+                self._discard(item)
+
+    # Leases and downloads a single job on `slot`, creating the sibling registration if needed.
+    def _prefetch(self, slot) -> tuple:
+        while not self._stop.is_set():
+            wait = self._empty_until - monotonic()
+            if wait > 0 and self._stop.wait(wait):
+                break
+            try:
+                if slot is None:
+                    slot = self.client._spawn()
+                slot.newJob()
+
+                self._counter += 1
+                staging = self.path + f".prefetch-{self._counter}/"
+                os.makedirs(staging, exist_ok=True)
+                slot.downloadShard(staging, self.chunk_size, self.segments)
+
+                return (slot, staging, None)
+            except ZeroJobError as e:
+                self._empty_until = monotonic() + self.retry_delay
+                return (slot, None, e)
+            except WorkerTimedOutError:
+                slot.recreate()
+            except Exception as e:
+                return (slot, None, e)
+
+        return (slot, None, None)
+
+    # Installs the next prefetched job on the client, blocking until one is ready if `block` is set.
+    # Returns False if no job was ready. Does nothing if a job is already installed and not yet released.
+    def handover(self, block: bool = True) -> bool:
+        if self._installed:
+            return True
+        if self._error is not None:
+            exc, self._error = self._error, None
+            raise exc
+
+        try:
+            slot, staging, exc = self._ready.get_nowait()
+        except Empty:
+            if not block:
+                return False
+            if monotonic() < self._empty_until:
+                raise ZeroJobError("[crawling@home] no jobs available")
+            slot, staging, exc = self._ready.get()
+
+        if exc is not None:
+            self._idle.put(slot)
+            if not block:
+                # Surface the failure on the next blocking handover (i.e. `newJob()`) instead.
+                self._error = exc
+                return False
+            raise exc
+
+        with self._lock:
+            if getattr(self.client, "_staged", None) is not None:
+                shutil.rmtree(self.client._staged, ignore_errors=True)
+            for field in _FIELDS:
+                mine = getattr(self.client, field, None)
+                setattr(self.client, field, getattr(slot, field, None))
+                setattr(slot, field, mine)
+            self.client._staged = staging
+            self._installed = True
+
+        self._idle.put(slot)
+        return True
+
+    # Marks the installed job as finished, so the next `handover()` installs a new one.
+    def release(self) -> None:
+        self._installed = False
+
+    # Stops prefetching, closing every sibling registration and removing undelivered downloads.
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        if self._sink is not None:
+            self._sink.untrack("cah_prefetch_queue_depth", self.qsize)
+
+        while True:
+            try:
+                self._discard(self._ready.get_nowait())
+            except Empty:
+                break
+        while True:
+            try:
+                slot = self._idle.get_nowait()
+            except Empty:
+                break
+            if slot is not None:
+                slot.bye()
+
+        if getattr(self.client, "_staged", None) is not None:
+            shutil.rmtree(self.client._staged, ignore_errors=True)
+            self.client._staged = None
+
+    def _discard(self, item: tuple) -> None:
+        slot, staging, _ = item
+        if staging is not None:
+            shutil.rmtree(staging, ignore_errors=True)
+        if slot is not None:
+            slot.bye()
+
+
+# Moves a prefetched job's downloaded files from `staging` into `path`, replacing the previous job's.
+def unstage(staging: str, path: str = "") -> None:
+    for name in os.listdir(staging):
+        target = path + name
+        if os.path.isdir(target) and not os.path.islink(target):
+            shutil.rmtree(target)
+        elif os.path.lexists(target):
+            os.remove(target)
+        os.replace(os.path.join(staging, name), target)
+    os.rmdir(staging)
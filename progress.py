@@ -0,0 +1,100 @@
+from threading import Thread, Condition
+from time import monotonic
+
+from . import metrics
+
+
+# Sends a client's progress updates from a background thread, so `log()` never blocks on the tracker.
+# Only the latest progress string is kept: updates submitted within the same `interval` overwrite each other,
+# and at most one request is made per `interval` seconds.
+class ProgressLogger:
+    def __init__(self, client, interval: float = 5.0) -> None:
+        self.client = client
+        self.interval = interval
+
+        self._cond = Condition()
+        self._pending = None
+        self._sending = False
+        self._error = None
+        self._closed = False
+        self._last = 0.0
+        self.coalesced = 0
+
+        self._sink = metrics.active
+        if self._sink is not None:
+            self._sink.track("cah_progress_pending", self.pending)
+
+        self._thread = Thread(target=self._run, name="cah-progress", daemon=True)
+        self._thread.start()
+
+    # Queues `progress` to be sent, replacing any update not yet sent. Never blocks on the network.
+    # Re-raises an error hit by a previous background send, e.g. `WorkerTimedOutError`.
+    def submit(self, progress: str) -> None:
+        with self._cond:
+            self._raise()
+            if self._pending is not None:
+                self.coalesced += 1
+                if self._sink is not None:
+                    self._sink.inc("cah_progress_coalesced_total")
+            self._pending = progress
+            self._cond.notify()
+
+    # Blocks until every submitted update has been sent.
+    def flush(self) -> None:
+        with self._cond:
+            self._last = 0.0
+            self._cond.notify()
+            while self._pending is not None or self._sending:
+                self._cond.wait()
+            self._raise()
+
+    # Flushes outstanding updates and stops the background thread. Send errors are dropped, as the client is closing.
+    def close(self) -> None:
+        try:
+            self.flush()
+        except Exception:
+            pass
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify()
+            self._thread.join()
+            if self._sink is not None:
+                self._sink.untrack("cah_progress_pending", self.pending)
+
+    # The amount of updates waiting to be sent (0 or 1).
+    def pending(self) -> int:
+        return int(self._pending is not None or self._sending)
+
+    def _raise(self) -> None:
+        if self._error is not None:
+            exc, self._error = self._error, None
+            raise exc
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if self._pending is not None:
+                        wait = self._last + self.interval - monotonic()
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+
+                progress, self._pending = self._pending, None
+                self._sending = True
+
+            try:
+                self.client._postProgress(progress)
+            except Exception as e:
+                with self._cond:
+                    self._error = e
+            finally:
+                with self._cond:
+                    self._last = monotonic()
+                    self._sending = False
+                    self._cond.notify_all()
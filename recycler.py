@@ -1,22 +1,45 @@
-import numpy as np
-from requests import session
+import struct
+import json
 
 from .core import CPUClient, GPUClient, HybridClient
+from .job import as_id
 from .temp import TempCPUWorker
+from .transport import make_session
 from .errors import *
 
+# Binary dump format (see `dumps`): a header, then every present string field as a length-prefixed UTF-8 string,
+# then the ids, then `shards` as a length-prefixed JSON string if present.
+_MAGIC = b"CAHD"
+_VERSION = 1
+_HEADER = struct.Struct("<4sBBH")  # magic, version, client type, bitmask of present fields
+_IDS = struct.Struct("<qqi")       # start_id, end_id, shard_piece
+_LEN = struct.Struct("<I")
+
+_TYPES = ("HYBRID", "CPU", "GPU", "FULLWAT")
+_STRINGS = ("url", "token", "nickname", "shard", "wat", "upload_address", "display_name")
+_START_ID, _END_ID, _SHARD_PIECE, _SHARDS = (1 << i for i in range(len(_STRINGS), len(_STRINGS) + 4))
+
+
+def _type(c) -> str:
+    return "FULLWAT" if isinstance(c, TempCPUWorker) else c.type
+
+
+def _token(c) -> str:
+    return c._c.token if isinstance(c, TempCPUWorker) else c.token
+
 
 # Dump a client's attributes into a dictionary so that it can be used remotely.
+# Async clients (`aio`) are dumped like their sync counterparts, and load back as sync clients.
 def dump(c):
     try:
         return {
-            "_type": c.type,
+            "_type": _type(c),
             "url": c.url,
-            "token": c.token,
+            "token": _token(c),
             "nickname": c.nickname,
             "shard": c.shard if hasattr(c, 'shard') else None,
-            "start_id": str(c.start_id) if hasattr(c, 'start_id') else None,
-            "end_id": str(c.end_id) if hasattr(c, 'end_id') else None,
+            "start_id": str(c.start_id) if getattr(c, 'start_id', None) is not None else None,
+            "end_id": str(c.end_id) if getattr(c, 'end_id', None) is not None else None,
             "shard_piece": c.shard_piece if hasattr(c, 'shard_piece') else None,
             "wat": c.wat if hasattr(c, 'wat') else None,
             "shards": c.shards if hasattr(c, 'shards') else None
@@ -25,9 +48,23 @@ def dump(c):
         raise DumpError(f"[crawling@home] unable to dump client: {e}")
 
 # Load an existing client using its attributes. It's best to load using an existing dumpClient(): `loadClient(**dump)`
+# Pass `session` (e.g. `transport.shared_session()`) to reuse an existing connection pool instead of opening a new one.
 def load(_type=None, url=None, token=None, nickname=None, shard=None,
-              start_id=None, end_id=None, shard_piece=None, wat=None, shards=None):
-    
+              start_id=None, end_id=None, shard_piece=None, wat=None, shards=None, session=None):
+
+    c = _new(_type, url, nickname, token, session)
+    c.shard = shard
+    c.start_id = start_id if start_id is None else as_id(start_id)
+    c.end_id = end_id if end_id is None else as_id(end_id)
+    c.shard_piece = shard_piece
+    c.wat = wat
+    c.shards = shards
+
+    return c
+
+
+# Creates an unconnected client of `_type` holding the given registration.
+def _new(_type, url, nickname, token, session):
     if _type == "HYBRID":
         c = HybridClient(*[None] * 2, _recycled=True)
     elif _type == "CPU":
@@ -38,17 +75,98 @@ def load(_type=None, url=None, token=None, nickname=None, shard=None,
         c = TempCPUWorker(url, nickname, _recycled=True)
     else:
         raise ValueError(f"Invalid worker type: {_type}")
-    
-    c.s = session()
-    c.type = _type
+
+    if session is not None:
+        c.s = session
+    else:
+        c.s = make_session(c.pool_size, c.timeout, c.keep_alive) if hasattr(c, 'pool_size') else make_session()
     c.url = url
-    c.token = token
     c.nickname = nickname
-    c.shard = shard
-    c.start_id = start_id if isinstance(start_id, np.int64) else np.int64(start_id)
-    c.end_id = end_id if isinstance(end_id, np.int64) else np.int64(end_id)
-    c.shard_piece = shard_piece
-    c.wat = wat
-    c.shards = shards
-    
+
+    if _type == "FULLWAT":
+        c.completed = 0
+        c._c = _new("CPU", url, nickname, token, c.s)
+    else:
+        c.type = _type
+        c.token = token
+
+    return c
+
+
+# Dumps a client into a compact, versioned binary string, covering its registration and job state
+# (including `TempCPUWorker.shards`). Restore it with `loads`.
+def dumps(c) -> bytes:
+    try:
+        fields = [
+            c.url, _token(c), c.nickname, getattr(c, "shard", None), getattr(c, "wat", None),
+            getattr(c, "upload_address", None), getattr(c, "display_name", None)
+        ]
+        kind = _TYPES.index(_type(c))
+    except (AttributeError, ValueError) as e:
+        raise DumpError(f"[crawling@home] unable to dump client: {e}")
+
+    start_id = getattr(c, "start_id", None)
+    end_id = getattr(c, "end_id", None)
+    shard_piece = getattr(c, "shard_piece", None)
+    shards = getattr(c, "shards", None)
+
+    mask = 0
+    body = []
+    for i, value in enumerate(fields):
+        if value is not None:
+            mask |= 1 << i
+            value = value.encode("utf-8")
+            body += [_LEN.pack(len(value)), value]
+
+    mask |= (start_id is not None and _START_ID) | (end_id is not None and _END_ID) | \
+            (shard_piece is not None and _SHARD_PIECE) | (shards is not None and _SHARDS)
+    body.append(_IDS.pack(int(start_id or 0), int(end_id or 0), int(shard_piece or 0)))
+
+    if shards is not None:
+        shards = json.dumps(shards, separators=(",", ":")).encode("utf-8")
+        body += [_LEN.pack(len(shards)), shards]
+
+    return _HEADER.pack(_MAGIC, _VERSION, kind, mask) + b"".join(body)
+
+
+# Restores a client dumped with `dumps`. Pass `session` to reuse an existing connection pool (see `load`).
+def loads(data: bytes, session=None):
+    data = bytes(data)
+    try:
+        magic, version, kind, mask = _HEADER.unpack_from(data)
+    except struct.error:
+        raise DumpError("[crawling@home] truncated client dump")
+    if magic != _MAGIC or version != _VERSION:
+        raise DumpError(f"[crawling@home] not a version {_VERSION} client dump")
+
+    offset = _HEADER.size
+    values = {}
+    try:
+        for i, name in enumerate(_STRINGS):
+            if mask & (1 << i):
+                n, = _LEN.unpack_from(data, offset)
+                offset += _LEN.size
+                values[name] = data[offset:offset + n].decode("utf-8")
+                offset += n
+
+        start_id, end_id, shard_piece = _IDS.unpack_from(data, offset)
+        offset += _IDS.size
+
+        shards = None
+        if mask & _SHARDS:
+            n, = _LEN.unpack_from(data, offset)
+            offset += _LEN.size
+            shards = json.loads(data[offset:offset + n])
+    except (struct.error, IndexError) as e:
+        raise DumpError(f"[crawling@home] truncated client dump: {e}")
+
+    c = load(
+        _TYPES[kind], values.get("url"), values.get("token"), values.get("nickname"), values.get("shard"),
+        start_id if mask & _START_ID else None, end_id if mask & _END_ID else None,
+        shard_piece if mask & _SHARD_PIECE else None, values.get("wat"), shards, session
+    )
+    for name in ("upload_address", "display_name"):
+        if name in values:
+            setattr(c, name, values[name])
+
     return c
@@ -0,0 +1,88 @@
+from time import monotonic
+import random
+
+
+# Describes how a failed tracker request is retried.
+# * Connection errors (any exception raised by the request) are retried until `max_attempts` attempts
+#   have been made or `deadline` seconds have passed; `None` means no limit.
+# * Responses with a status in `retry_statuses` (e.g. 429/5xx) are retried up to `status_attempts` times,
+#   after which the last response is returned to the caller as usual.
+# Delays grow exponentially from `base_delay` up to `max_delay`, with full jitter so that a fleet of
+# workers doesn't retry in lock-step.
+class RetryPolicy:
+    def __init__(self, max_attempts: int = None, deadline: float = None, base_delay: float = 1.0,
+                 max_delay: float = 60.0, retry_statuses=(429, 500, 502, 503, 504), status_attempts: int = 10) -> None:
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = frozenset(retry_statuses)
+        self.status_attempts = status_attempts
+
+    # The randomised delay before retry number `attempt` (starting at 1).
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    # Starts tracking a single request's retry budget.
+    def start(self) -> "RetryState":
+        return RetryState(self)
+
+
+# The retry budget of a single request under a `RetryPolicy`.
+class RetryState:
+    def __init__(self, policy: RetryPolicy) -> None:
+        self.policy = policy
+        self.attempts = 0
+        self.status_attempts = 0
+        self.started = monotonic()
+
+    # Returns the delay before retrying after a connection error, or None if the budget is spent.
+    def onError(self) -> float:
+        self.attempts += 1
+        p = self.policy
+        if p.max_attempts is not None and self.attempts >= p.max_attempts:
+            return None
+        return self._bounded(p.delay(self.attempts))
+
+    # Returns the delay before retrying a response with `status_code`, or None if it should be returned as-is.
+    def onStatus(self, status_code: int) -> float:
+        p = self.policy
+        if status_code not in p.retry_statuses:
+            return None
+        self.status_attempts += 1
+        self.attempts += 1
+        if self.status_attempts >= p.status_attempts:
+            return None
+        if p.max_attempts is not None and self.attempts >= p.max_attempts:
+            return None
+        return self._bounded(p.delay(self.attempts))
+
+    def _bounded(self, delay: float) -> float:
+        if self.policy.deadline is None:
+            return delay
+        remaining = self.policy.deadline - (monotonic() - self.started)
+        if remaining <= 0:
+            return None
+        return min(delay, remaining)
+
+
+# Retry policies used by the clients when none are given, keyed by endpoint (`None` is the fallback).
+# Progress updates give up sooner with shorter delays, as they are cheap to lose; leasing a job waits out
+# long tracker outages with longer delays.
+DEFAULT_POLICIES = {
+    None: RetryPolicy(),
+    "api/newJob": RetryPolicy(max_delay=120.0),
+    "api/updateProgress": RetryPolicy(deadline=300.0, max_delay=15.0, status_attempts=5),
+}
+
+
+# Resolves the `RetryPolicy` for `url` from `policy`: a policy, a dict of endpoint -> policy, or None for the defaults.
+def select_policy(policy, url: str) -> RetryPolicy:
+    if isinstance(policy, RetryPolicy):
+        return policy
+
+    policies = DEFAULT_POLICIES if policy is None else policy
+    for endpoint, p in policies.items():
+        if endpoint is not None and url.endswith(endpoint):
+            return p
+    return policies.get(None) or DEFAULT_POLICIES[None]
@@ -0,0 +1,184 @@
+from multiprocessing import get_context
+from time import sleep, monotonic
+import json
+import os
+
+from .core import init, print
+from .recycler import dump, load
+from .errors import ZeroJobError, WorkerTimedOutError
+
+# Registration attributes saved alongside the client's `dump()`, which doesn't include them.
+_EXTRA = ("upload_address", "display_name")
+
+# Default number of times a worker is restarted in a row without completing a job before it is given up on.
+MAX_RESTARTS = 5
+
+
+# Runs `n` workers of `type` in separate processes, each in its own `path + "worker-<i>/"` directory.
+# `work(client, path)` processes the client's current job (already downloaded to `path`) and returns the value
+# passed to `client.completeJob(...)`. Crashed workers are restarted from their last dumped client state, and
+# the aggregate job rate is reported every `report_interval` seconds.
+# A worker that crashes `max_restarts` times in a row without completing a job (None for no limit) is marked failed:
+# its registration is closed, giving its open job back to the server, and its last state is kept as
+# `client.failed.json`.
+class Supervisor:
+    def __init__(self, work, n: int = None, type="HYBRID", url: str = "http://crawlingathome.duckdns.org/",
+                 nickname: str = "anonymous", path: str = "", max_restarts: int = MAX_RESTARTS,
+                 report_interval: int = 600, start_method: str = None) -> None:
+        self.work = work
+        self.n = n or os.cpu_count()
+        self.type = type
+        self.url = url
+        self.nickname = nickname
+        self.path = path
+        self.max_restarts = max_restarts
+        self.report_interval = report_interval
+
+        self._ctx = get_context(start_method)
+        self._completed = self._ctx.Array("q", self.n)
+        self._procs = [None] * self.n
+        self._streaks = [0] * self.n     # restarts since the worker last completed a job
+        self._progress = [0] * self.n    # the worker's completed jobs when it was last started
+        self.restarts = 0
+        self.failed = []
+
+    # Total jobs completed by every worker so far.
+    def completed(self) -> int:
+        return sum(self._completed)
+
+    # Starts the workers and supervises them until every worker exits cleanly (no jobs left / worker not alive).
+    def run(self) -> None:
+        start = monotonic()
+        last_report = start
+
+        for i in range(self.n):
+            self._start(i)
+
+        try:
+            while any(p is not None for p in self._procs):
+                for i, p in enumerate(self._procs):
+                    if p is None or p.is_alive():
+                        continue
+
+                    p.join()
+                    if self._completed[i] > self._progress[i]:
+                        self._streaks[i] = 0
+                    if p.exitcode == 0:
+                        self._procs[i] = None
+                    elif self.max_restarts is not None and self._streaks[i] >= self.max_restarts:
+                        print(f"worker {i} crashed (exit code {p.exitcode}) {self._streaks[i] + 1} times in a row, giving up on it")
+                        self._procs[i] = None
+                        self._fail(i)
+                    else:
+                        print(f"worker {i} crashed (exit code {p.exitcode}), restarting from its last state...")
+                        self.restarts += 1
+                        self._streaks[i] += 1
+                        self._start(i)
+
+                now = monotonic()
+                if now - last_report >= self.report_interval:
+                    last_report = now
+                    print(f"{self.completed()} jobs completed by {self.n} workers ({self.jobsPerHour(now - start):.1f} jobs/hour)")
+
+                sleep(1)
+        finally:
+            for p in self._procs:
+                if p is not None and p.is_alive():
+                    p.terminate()
+                    p.join()
+
+        print(f"all workers finished: {self.completed()} jobs in total ({self.jobsPerHour(monotonic() - start):.1f} jobs/hour)")
+        if self.failed:
+            print(f"{len(self.failed)} worker(s) failed: {', '.join(map(str, sorted(self.failed)))}")
+
+    def jobsPerHour(self, elapsed: float) -> float:
+        return self.completed() * 3600 / elapsed if elapsed > 0 else 0.0
+
+    def _start(self, i: int) -> None:
+        worker_path = self.path + f"worker-{i}/"
+        os.makedirs(worker_path, exist_ok=True)
+
+        p = self._ctx.Process(
+            target=_worker,
+            args=(i, self.work, self.type, self.url, self.nickname, worker_path, self._completed),
+            name=f"cah-worker-{i}",
+            daemon=False
+        )
+        p.start()
+        self._procs[i] = p
+        self._progress[i] = self._completed[i]
+
+    # Marks worker `i` as failed, closing its registration so the server can hand its open job to another worker.
+    def _fail(self, i: int) -> None:
+        self.failed.append(i)
+        state_path = self.path + f"worker-{i}/client.json"
+        if not os.path.exists(state_path):
+            return
+
+        try:
+            client, open_job = _load_state(state_path)
+            client.bye()
+            if open_job:
+                print(f"worker {i}: released its open job ({client.shard})")
+        except Exception as e:
+            print(f"worker {i}: unable to release its open job ({type(e).__name__}: {e})")
+        os.replace(state_path, self.path + f"worker-{i}/client.failed.json")
+
+
+# Creates a `Supervisor` and runs it until every worker is finished.
+def supervise(work, n: int = None, type="HYBRID", **kwargs) -> Supervisor:
+    s = Supervisor(work, n, type, **kwargs)
+    s.run()
+    return s
+
+
+def _save_state(state_path: str, client, open_job: bool) -> None:
+    extra = {name: getattr(client, name) for name in _EXTRA if getattr(client, name, None) is not None}
+    with open(state_path + ".tmp", "w") as f:
+        json.dump({"client": dump(client), "extra": extra, "open": open_job}, f)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def _load_state(state_path: str):
+    with open(state_path) as f:
+        state = json.load(f)
+    client = load(**state["client"])
+    for name, value in state.get("extra", {}).items():
+        if name in _EXTRA:
+            setattr(client, name, value)
+    return client, state["open"] and client.shard is not None
+
+
+# The loop run inside each worker process.
+def _worker(i: int, work, type, url: str, nickname: str, path: str, completed) -> None:
+    state_path = path + "client.json"
+    open_job = False
+
+    if os.path.exists(state_path):
+        client, open_job = _load_state(state_path)
+    else:
+        client = init(url, nickname, type)
+        _save_state(state_path, client, False)
+
+    while open_job or (client.jobCount() > 0 and client.isAlive()):
+        try:
+            if not open_job:
+                client.newJob()
+                _save_state(state_path, client, True)
+
+            client.downloadShard(path)
+            result = work(client, path)
+            client.completeJob(result)
+
+            open_job = False
+            _save_state(state_path, client, False)
+            completed[i] += 1
+        except ZeroJobError:
+            sleep(30)
+        except WorkerTimedOutError:
+            client.recreate()
+            open_job = False
+            _save_state(state_path, client, False)
+
+    client.bye()
+    os.remove(state_path)
@@ -0,0 +1,142 @@
+from subprocess import Popen, DEVNULL
+from time import sleep, monotonic
+import tarfile
+import io
+import os
+
+from .download import CHUNK_SIZE
+from .errors import IncompleteArchiveError
+from . import metrics
+
+# Where `rsync <uid>` GPU jobs are fetched from. Point this at a local rsync daemon for testing.
+RSYNC_SOURCE = "archiveteam@5.9.55.230::gpujobs/"
+
+# rsync's exit code for a missing source file ("some files could not be transferred").
+RSYNC_NOT_FOUND = 23
+
+
+# Resolves `name` inside `path`, refusing members that would escape it (absolute paths, `..`, links).
+def _target(path: str, member: tarfile.TarInfo) -> str:
+    root = os.path.realpath(path or ".")
+    target = os.path.realpath(os.path.join(root, member.name))
+    if target != root and not target.startswith(root + os.sep):
+        raise tarfile.TarError(f"[crawling@home] refusing to extract {member.name!r} outside of {root}")
+    return target
+
+
+# Extracts the gzipped tar read from `fileobj` into `path` member by member as it is read, using bounded memory.
+# Every regular file is checked to have been written in full; a truncated stream raises `IncompleteArchiveError`.
+# Returns the names of the extracted members.
+def extract_stream(fileobj, path: str = "") -> list:
+    names = []
+    os.makedirs(path or ".", exist_ok=True)
+
+    try:
+        with tarfile.open(fileobj=fileobj, mode="r|gz", bufsize=CHUNK_SIZE) as tar:
+            for member in tar:
+                if not (member.isfile() or member.isdir()):
+                    continue  # links and devices have no place in a job archive
+                target = _target(path, member)
+
+                if member.isdir():
+                    os.makedirs(target, exist_ok=True)
+                    continue
+
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                src = tar.extractfile(member)
+                written = 0
+                with open(target, "wb") as dst:
+                    while True:
+                        chunk = src.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        written += len(chunk)
+
+                if written != member.size:
+                    raise IncompleteArchiveError(f"[crawling@home] {member.name} is truncated ({written} / {member.size} bytes)")
+                names.append(member.name)
+    except (EOFError, tarfile.ReadError, OSError) as e:
+        if isinstance(e, IncompleteArchiveError):
+            raise
+        raise IncompleteArchiveError(f"[crawling@home] archive ended early after {len(names)} members: {e}")
+
+    return names
+
+
+# A read-only file object over a file that is still being written by `proc`: reads wait for more data
+# until the process exits, so the archive can be extracted while it downloads.
+class _FollowFile(io.RawIOBase):
+    def __init__(self, filename: str, proc: Popen, poll: float = 0.05) -> None:
+        self.filename = filename
+        self.proc = proc
+        self.poll = poll
+        self._f = None
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while True:
+            if self._f is None and os.path.exists(self.filename):
+                self._f = open(self.filename, "rb")
+            if self._f is not None:
+                n = self._f.readinto(b)
+                if n:
+                    return n
+            if self.proc.poll() is not None:
+                # the transfer finished; drain whatever it wrote last
+                if self._f is None and os.path.exists(self.filename):
+                    continue
+                return self._f.readinto(b) if self._f is not None else 0
+            sleep(self.poll)
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._f.close()
+        super().close()
+
+
+# Fetches `source` (an rsync path) into `archive` with rsync, extracting it into `path` while it transfers.
+# The archive is deleted afterwards. Returns (rsync exit code, extracted member names).
+def rsync_extract(source: str, archive: str, path: str = "") -> tuple:
+    if os.path.exists(archive):
+        os.remove(archive)
+
+    proc = Popen(["rsync", "-a", "--inplace", source, archive], stdout=DEVNULL)
+    names = None
+    try:
+        with _FollowFile(archive, proc) as f:
+            try:
+                names = extract_stream(io.BufferedReader(f, CHUNK_SIZE), path)
+            except IncompleteArchiveError:
+                if proc.wait() == 0:
+                    raise
+        code = proc.wait()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if os.path.exists(archive):
+            os.remove(archive)
+
+    return code, names
+
+
+# Extracts the gzipped tar at `url` into `path` while it streams, for http(s):// and file:// URLs.
+# Returns the extracted member names.
+def fetch_extract(s, url: str, path: str = "") -> list:
+    if url.startswith("file://"):
+        with open(url[len("file://"):], "rb") as f:
+            return extract_stream(f, path)
+
+    started = monotonic()
+    with s.get(url, stream=True) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        names = extract_stream(r.raw, path)
+
+        if metrics.active is not None:
+            metrics.active.inc("cah_download_bytes_total", r.raw.tell(), {"kind": "archive"})
+            metrics.active.observe("cah_download_seconds", monotonic() - started, {"kind": "archive"})
+    return names
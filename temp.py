@@ -1,10 +1,11 @@
-from requests import session
-import os, shutil, gzip
-from time import sleep
-
+from .download import fetch_shard
 from .errors import WorkerTimedOutError
+from .transport import make_session
 from .core import CPUClient
 from .core import print as cahprint
+from .trace import traced
+from .watlookup import WatLookup
+from . import trace
 
 
 class TempCPUWorker:
@@ -18,7 +19,7 @@ class TempCPUWorker:
         if url[-1] != "/":
             url += "/"
         
-        self.s = session()
+        self.s = make_session()
         self.url = url
         self.nickname = nickname
         
@@ -41,34 +42,39 @@ class TempCPUWorker:
         
         self.upload_address = self._c.upload_address
     
-    def log(self, msg: str) -> None:
+    # Retries once on a new registration if the current one timed out.
+    def log(self, msg: str, noprint=True) -> None:
         try:
-            self._c.log(msg, noprint=True)
+            self._c.log(msg, noprint=noprint)
         except WorkerTimedOutError:
             self._c = CPUClient(self.url, self.nickname)
-            self.log(msg)
+            self.upload_address = self._c.upload_address
+            self._c.log(msg, noprint=noprint)
+        trace.instant(self, msg)
+    
+    def span(self, name: str, **args):
+        return trace.span(self, name, **args)
     
     
     def jobCount(self) -> int:
         return self._c.jobCount()
     
     
-    def downloadWat(self, path="") -> None:
+    def enableCache(self, path=None, max_size=None) -> None:
+        if getattr(self, "_cache", None) is None:
+            from . import cache
+            self._cache = cache.ShardCache(path or cache.DEFAULT_PATH, max_size or cache.DEFAULT_MAX_SIZE)
+    
+    
+    @traced("download")
+    def downloadWat(self, path="", chunk_size=None, segments=1) -> None:
         cahprint("downloading shard...")
         self.log("Downloading WAT")
 
-        with self.s.get(self.wat, stream=True) as r:
-            r.raise_for_status()
-            with open(path + "temp.gz", 'w+b') as f:
-                for chunk in r.iter_content(chunk_size=8192): 
-                    f.write(chunk)
-            
-        with gzip.open(path + 'temp.gz', 'rb') as f_in:
-            with open(path + 'shard.wat', 'w+b') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-            
-        sleep(1) # Causes errors otherwise?
-        os.remove(path + "temp.gz")
+        if getattr(self, "_cache", None) is not None:
+            self._cache.fetch(self.s, self.wat, path + "shard.wat", chunk_size, segments)
+        else:
+            fetch_shard(self.s, self.wat, path + "shard.wat", chunk_size, segments)
 
         self.log("Downloaded WAT")
         cahprint("finished downloading shard")
@@ -83,32 +89,38 @@ class TempCPUWorker:
             self.updateUploadServer()
     
     
+    @traced("upload")
+    def upload(self, filename: str, name: str = None, **kwargs) -> str:
+        from .upload import Uploader
+        return Uploader(client=self, **kwargs).upload(filename, name)
+    
+    
+    # Leases the next WAT with at least two open shards, raising `ZeroJobError` when the tracker has none left
+    # (see `watlookup.WatLookup`).
+    @traced("lease", begin=True)
     def newJob(self) -> None:
-        while True:
-            wat = self.s.get(self.url + "custom/get-cpu-wat").text
-            if not "http" in wat:
-                cahprint("something went wrong when finding a job, breaking loop...")
-                self.log("Crashed")
-                break
-            
-            # verify
-            r = self.s.post(self.url + "custom/lookup-wat", json={
-                "url": wat
-            }).json()
-            
-            if r["status"] != "success":
-                continue
-            else:
-                shards = r["shards"]
-                if len(shards) < 2:
-                    continue
-                else:
-                    self.shards = shards
-                    self.wat = wat
-                    self.log("Recieved new jobs")
-                    break
+        if getattr(self, "_lookup", None) is None:
+            self._lookup = WatLookup(self)
+
+        self.wat, self.shards = self._lookup.next()
+        self.log("Recieved new jobs")
+    
+    
+    # Verifies candidate WATs on `workers` background threads, keeping up to `depth` of them ready for `newJob()`.
+    def enablePrefetch(self, depth=1, workers=4) -> None:
+        if getattr(self, "_lookup", None) is None:
+            self._lookup = WatLookup(self)
+        self._lookup.start(depth, workers)
+    
+    
+    # Stops prefetching WATs and removes the worker from the server.
+    def bye(self) -> None:
+        if getattr(self, "_lookup", None) is not None:
+            self._lookup.stop()
+        self._c.bye()
     
     
+    @traced("complete", end=True)
     def completeJob(self, urls: dict) -> None:
         r = self.s.post(self.url + "custom/markasdone-cpu", json={
             "urls": urls,
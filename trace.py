@@ -0,0 +1,152 @@
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter, time
+import threading
+import json
+import os
+import re
+
+# The `Tracer` recording job timelines, or None while tracing is disabled (the default).
+active = None
+
+
+# The timeline of a single job: spans and `log()` checkpoints from lease to completion, as Chrome trace events.
+class JobTrace:
+    def __init__(self, tracer: "Tracer", worker: str) -> None:
+        self.tracer = tracer
+        self.worker = worker
+        self.events = []
+        self.metadata = {"worker": worker, "started": time()}
+        self._origin = perf_counter()
+        self._root = tracer._otelJob(worker) if tracer.otel else None
+
+    def _us(self, t: float) -> float:
+        return round((t - self._origin) * 1e6, 1)
+
+    def span(self, name: str, started: float, ended: float, args: dict) -> None:
+        self.events.append({
+            "name": name, "ph": "X", "ts": self._us(started), "dur": round((ended - started) * 1e6, 1),
+            "pid": os.getpid(), "tid": threading.get_ident(), "args": args
+        })
+
+    def instant(self, name: str, args: dict = None) -> None:
+        self.events.append({
+            "name": name, "ph": "i", "s": "t", "ts": self._us(perf_counter()),
+            "pid": os.getpid(), "tid": threading.get_ident(), "args": args or {}
+        })
+
+    # Returns the timeline in the Chrome trace-event format (viewable in chrome://tracing or Perfetto).
+    def to_chrome(self) -> dict:
+        return {"traceEvents": self.events, "displayTimeUnit": "ms", "otherData": self.metadata}
+
+    # Writes the timeline to the tracer's directory, returning the file's path.
+    def write(self) -> str:
+        name = "-".join(str(self.metadata.get(k)) for k in ("worker", "shard_piece", "start_id") if k in self.metadata)
+        path = os.path.join(self.tracer.path, re.sub(r"[^\w.-]+", "_", name) + f"-{int(self.metadata['started'] * 1000)}.json")
+        os.makedirs(self.tracer.path, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_chrome(), f)
+        if self._root is not None:
+            self._root.set_attributes({k: str(v) for k, v in self.metadata.items()})
+            self._root.end()
+        return path
+
+
+# Records a timeline per job and writes it to `path` as a Chrome trace-event JSON file once the job is done
+# (the latest file's path is kept in `last`).
+# With `otel`, every span is also exported through OpenTelemetry (requires `opentelemetry-api`, configured by
+# the application), with one root span per job.
+class Tracer:
+    def __init__(self, path: str = "traces", otel: bool = False) -> None:
+        self.path = path
+        self.otel = otel
+        self.last = None
+        if otel:
+            from opentelemetry import trace as _otel  # fail early if OpenTelemetry isn't installed
+            self._otel = _otel.get_tracer("crawlingathome")
+
+    def _otelJob(self, worker: str):
+        return self._otel.start_span("job", attributes={"worker": worker})
+
+    @contextmanager
+    def _otelSpan(self, job: JobTrace, name: str, args: dict):
+        if job is None or job._root is None:
+            yield
+            return
+        from opentelemetry import trace as _otel
+        with self._otel.start_as_current_span(name, context=_otel.set_span_in_context(job._root), attributes=args):
+            yield
+
+
+# Enables tracing, returning the `Tracer`.
+def enable(path: str = "traces", otel: bool = False) -> Tracer:
+    global active
+    active = Tracer(path, otel)
+    return active
+
+
+def disable() -> None:
+    global active
+    active = None
+
+
+def _worker(client) -> str:
+    return getattr(client, "display_name", None) or getattr(client, "nickname", None) or "worker"
+
+
+# Records the block as a span named `name` on `client`'s current job timeline (a no-op while tracing is disabled
+# or outside a job). `args` are attached to the span. If the block installs another timeline on `client` (e.g. a
+# prefetched job handed over by `newJob()`), the span is recorded on that one.
+@contextmanager
+def span(client, name: str, **args):
+    tracer = active
+    job = getattr(client, "_trace", None) if tracer is not None else None
+    if job is None:
+        yield
+        return
+
+    started = perf_counter()
+    try:
+        with tracer._otelSpan(job, name, args):
+            yield
+    finally:
+        (getattr(client, "_trace", None) or job).span(name, started, perf_counter(), args)
+
+
+# Records a checkpoint (e.g. a `log()` message) on `client`'s current job timeline.
+def instant(client, name: str, **args) -> None:
+    job = getattr(client, "_trace", None)
+    if job is not None:
+        job.instant(name, args)
+
+
+# Wraps a client method in a span. `begin` starts a new job timeline before the method runs (leasing a job)
+# and `end` writes it once the method returns (completing the job).
+def traced(name: str, begin: bool = False, end: bool = False):
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            tracer = active
+            if tracer is None:
+                return method(self, *args, **kwargs)
+
+            if begin:
+                self._trace = JobTrace(tracer, _worker(self))
+            started = self._trace if begin else None
+            with span(self, name):
+                result = method(self, *args, **kwargs)
+
+            job = getattr(self, "_trace", None)
+            if started is not None and job is not started and started._root is not None:
+                started._root.end()  # replaced by a prefetched job's timeline
+            if begin and job is not None:
+                for key in ("shard", "start_id", "end_id", "shard_piece", "wat"):
+                    value = getattr(self, key, None)
+                    if value is not None:
+                        job.metadata[key] = value if isinstance(value, str) else int(value)
+            if end and job is not None:
+                tracer.last = job.write()
+                self._trace = None
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,51 @@
+from requests.adapters import HTTPAdapter
+from requests import Session
+import os
+
+# Default (connect, read) timeout in seconds for every request made by the clients.
+DEFAULT_TIMEOUT = (10, 60)
+
+# Default amount of pooled keep-alive connections kept per host.
+DEFAULT_POOL_SIZE = 10
+
+
+# A `requests.Session` that applies a default timeout to every request that doesn't set one,
+# so a hung tracker or shard host can never stall a worker forever.
+class TimeoutSession(Session):
+    def __init__(self, timeout=DEFAULT_TIMEOUT) -> None:
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+# Creates the pooled session used by a client.
+# * `pool_size`: the amount of keep-alive connections kept per host (raise this for many download segments)
+# * `timeout`: the default (connect, read) timeout in seconds, or None to wait forever
+# * `keep_alive`: set to False to close connections after every request
+def make_session(pool_size: int = DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, keep_alive: bool = True) -> Session:
+    s = TimeoutSession(timeout)
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+
+    if not keep_alive:
+        s.headers["Connection"] = "close"
+
+    return s
+
+
+_shared = {}
+
+# Returns a pooled session shared by every caller in this process (e.g. restored clients), created on first use.
+# A forked child gets its own session instead of reusing its parent's connections.
+def shared_session() -> Session:
+    pid = os.getpid()
+    s = _shared.get(pid)
+    if s is None:
+        _shared.clear()
+        s = _shared[pid] = make_session()
+    return s
@@ -0,0 +1,198 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from subprocess import run, DEVNULL
+from threading import Lock
+from time import sleep, monotonic
+import hashlib
+import os
+
+from .errors import UploadError
+from .retry import RetryPolicy
+from .transport import make_session
+from . import metrics
+
+# Bytes sent per chunk (8 MiB).
+DEFAULT_CHUNK_SIZE = 8 << 20
+
+# How each chunk (and the final commit) is retried against one upload server before it counts as failed.
+CHUNK_POLICY = RetryPolicy(max_attempts=4, base_delay=0.5, max_delay=8.0,
+                           retry_statuses=(408, 422, 429, 500, 502, 503, 504), status_attempts=4)
+
+# Default (connect, read) timeout of each chunk request: short, so a stalled upload fails over before the lease expires.
+DEFAULT_TIMEOUT = (10, 30)
+
+
+# Uploads result files to the client's `upload_address`, returning the URL the GPU workers download them from.
+# HTTP(S) addresses receive the file in chunks, `workers` at a time:
+# * `GET <address><name>` returns `{"chunks": {"<index>": "<sha256>"}}` for the chunks the server already has (or 404)
+# * `PUT <address><name>?chunk=<index>` stores a chunk, checked against its `X-Chunk-SHA256` header (422 if corrupt)
+# * `POST <address><name>` with `{"size", "chunk_size", "chunks", "sha256"}` joins the chunks, checks the whole
+#   file and returns `{"url": <download URL>}`
+# Chunks the server already holds with the right digest are skipped, so an interrupted upload resumes where it
+# stopped, even from another process. Other addresses (e.g. `user@host::module/`) are uploaded with
+# `rsync --partial --append-verify`, and the returned URL is `rsync<name without .tar.gz>` (see `GPUClient.downloadShard`).
+# Once a chunk fails `policy` on one server, `client.updateUploadServer()` is called and the upload continues
+# against the new address, up to `failovers` times before `UploadError` is raised.
+class Uploader:
+    def __init__(self, client=None, address: str = None, chunk_size: int = DEFAULT_CHUNK_SIZE, workers: int = 4,
+                 policy: RetryPolicy = CHUNK_POLICY, failovers: int = 3, timeout=DEFAULT_TIMEOUT,
+                 log_interval: float = 30.0, session=None) -> None:
+        self.client = client
+        self.address = address
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.policy = policy
+        self.failovers = failovers
+        self.log_interval = log_interval
+        self.s = session or make_session(workers, timeout)
+
+        self.sent = 0
+        self.skipped = 0
+        self.failures = 0
+        self._lock = Lock()
+        self._last_log = 0.0
+
+    def _address(self) -> str:
+        address = self.address or self.client.upload_address
+        return address if address.endswith(("/", "::")) else address + "/"
+
+    # Uploads `filename` as `name` (its base name by default), returning its download URL.
+    def upload(self, filename: str, name: str = None) -> str:
+        name = name or os.path.basename(filename)
+        size = os.path.getsize(filename)
+        digests, sha256 = _digests(filename, self.chunk_size)
+
+        errors = []
+        for attempt in range(self.failovers + 1):
+            address = self._address()
+            try:
+                if address.startswith(("http://", "https://")):
+                    return self._http(address, filename, name, size, digests, sha256)
+                return self._rsync(address, filename, name)
+            except UploadError as e:
+                errors.append(f"{address}: {e}")
+                self.failures += 1
+                if self.client is None or attempt == self.failovers:
+                    break
+                if metrics.active is not None:
+                    metrics.active.inc("cah_upload_failovers_total")
+                self.client.log(f"Upload to {address} failed, switching upload server", noprint=True)
+                self.client.updateUploadServer()
+
+        raise UploadError(f"[crawling@home] unable to upload {name}: " + "; ".join(errors))
+
+    def _http(self, address: str, filename: str, name: str, size: int, digests: list, sha256: str) -> str:
+        url = address + name
+        stored = self._status(url)
+        missing = [i for i, digest in enumerate(digests) if stored.get(str(i)) != digest]
+        self.skipped += len(digests) - len(missing)
+        self._progress(name, len(digests) - len(missing), len(digests), force=True)
+
+        if missing:
+            with ThreadPoolExecutor(self.workers, thread_name_prefix="cah-upload") as pool:
+                done = [len(digests) - len(missing)]
+                futures = [pool.submit(self._chunk, url, filename, i, digests[i], size, name, done, len(digests))
+                           for i in missing]
+                wait(futures, return_when=FIRST_EXCEPTION)
+                for future in futures:
+                    future.cancel()
+                for future in futures:
+                    if not future.cancelled():
+                        future.result()
+
+        r = self._send(self.s.post, url, json={
+            "size": size, "chunk_size": self.chunk_size, "chunks": len(digests), "sha256": sha256
+        })
+        try:
+            return r.json()["url"]
+        except (ValueError, KeyError, TypeError):
+            raise UploadError(f"invalid commit response from {url}: {r.text[:200]!r}")
+
+    # Returns {chunk index: sha256} of the chunks already stored on the server.
+    def _status(self, url: str) -> dict:
+        r = self._send(self.s.get, url, allow=(404,))
+        if r.status_code == 404:
+            return {}
+        try:
+            return dict(r.json().get("chunks") or {})
+        except (ValueError, AttributeError, TypeError):
+            return {}
+
+    def _chunk(self, url: str, filename: str, index: int, digest: str, size: int, name: str, done: list, total: int) -> None:
+        with open(filename, "rb") as f:
+            data = os.pread(f.fileno(), self.chunk_size, index * self.chunk_size)
+
+        self._send(self.s.put, url, params={"chunk": index}, data=data, headers={
+            "X-Chunk-SHA256": digest, "X-Upload-Size": str(size), "X-Chunk-Size": str(self.chunk_size),
+            "Content-Type": "application/octet-stream"
+        })
+
+        with self._lock:
+            self.sent += len(data)
+            done[0] += 1
+        if metrics.active is not None:
+            metrics.active.inc("cah_upload_bytes_total", len(data))
+        self._progress(name, done[0], total, force=done[0] == total)
+
+    # Makes a request under `policy`, raising `UploadError` once it is exhausted or the server refuses it.
+    def _send(self, function, url: str, allow=(), **kwargs):
+        state = self.policy.start()
+        while True:
+            try:
+                r = function(url, **kwargs)
+            except Exception as e:
+                delay = state.onError()
+                if delay is None:
+                    raise UploadError(f"{type(e).__name__}: {e}")
+                sleep(delay)
+                continue
+
+            if r.status_code == 200 or r.status_code in allow:
+                return r
+            delay = state.onStatus(r.status_code)
+            if delay is None:
+                raise UploadError(f"status {r.status_code}: {r.text[:200]}")
+            sleep(delay)
+
+    def _rsync(self, address: str, filename: str, name: str) -> str:
+        state = self.policy.start()
+        while True:
+            try:
+                code = run(["rsync", "--partial", "--append-verify", "--timeout=60", filename, address + name],
+                           stdout=DEVNULL, stderr=DEVNULL).returncode
+            except OSError as e:
+                raise UploadError(f"unable to run rsync: {e}")
+            if code == 0:
+                if metrics.active is not None:
+                    metrics.active.inc("cah_upload_bytes_total", os.path.getsize(filename))
+                return "rsync" + (name[:-len(".tar.gz")] if name.endswith(".tar.gz") else name)
+            delay = state.onError()
+            if delay is None:
+                raise UploadError(f"rsync exit code {code}")
+            sleep(delay)
+
+    # Reports progress through the client every `log_interval` seconds, keeping its job alive during long uploads.
+    def _progress(self, name: str, done: int, total: int, force: bool = False) -> None:
+        if self.client is None:
+            return
+        with self._lock:
+            now = monotonic()
+            if not force and now - self._last_log < self.log_interval:
+                return
+            self._last_log = now
+        self.client.log(f"Uploading {name}: {done}/{total} chunks", noprint=True)
+
+
+# Returns the sha256 hex digests of every `chunk_size` chunk of `filename`, and of the whole file.
+def _digests(filename: str, chunk_size: int) -> tuple:
+    digests = []
+    whole = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk and digests:
+                break
+            digests.append(hashlib.sha256(chunk).hexdigest())
+            whole.update(chunk)
+            if not chunk:
+                break
+    return digests, whole.hexdigest()
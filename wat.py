@@ -0,0 +1,208 @@
+from typing import Iterator, Optional
+from collections import deque
+from bisect import bisect_left
+import mmap
+import zlib
+
+from .download import CHUNK_SIZE, read_members
+
+_WARC = b"WARC/"
+_HEADER_END = b"\r\n\r\n"
+
+
+# A single WARC record from a WAT file.
+# * `headers`: the record's WARC headers, e.g. `headers["WARC-Type"]`
+# * `payload`: the record body. A zero-copy `memoryview` into the mapped file for `iter_records`, `bytes` when streaming.
+# * `offset`: where the record starts in the decompressed WAT
+class WatRecord:
+    __slots__ = ("headers", "payload", "offset")
+
+    def __init__(self, headers: dict, payload, offset: int) -> None:
+        self.headers = headers
+        self.payload = payload
+        self.offset = offset
+
+    @property
+    def type(self) -> Optional[str]:
+        return self.headers.get("WARC-Type")
+
+    @property
+    def target(self) -> Optional[str]:
+        return self.headers.get("WARC-Target-URI")
+
+    def __repr__(self) -> str:
+        return f"<WatRecord {self.type} {self.target} ({len(self.payload)} bytes)>"
+
+
+# Parses the record starting at `start` in `buf`.
+# Returns (headers, payload start, payload end), or None if the record isn't complete within `buf` yet.
+def _parse_header(buf, start: int) -> Optional[tuple]:
+    end = buf.find(_HEADER_END, start)
+    if end == -1:
+        return None
+
+    headers = {}
+    for line in bytes(buf[start:end]).decode("utf-8", "replace").split("\r\n")[1:]:
+        key, _, value = line.partition(":")
+        headers[key.strip()] = value.strip()
+
+    body = end + len(_HEADER_END)
+    length = int(headers.get("Content-Length", 0))
+    if body + length > len(buf):
+        return None
+    return headers, body, body + length
+
+
+# Returns the offset of the next record at or after `pos` (skipping the blank lines between records), or -1.
+def _next_record(buf, pos: int) -> int:
+    return buf.find(_WARC, pos)
+
+
+# Returns the [first, last) offsets belonging to `shard_piece` out of `count` bytes split into `pieces`.
+def piece_bounds(count: int, shard_piece: int, pieces: int = 2) -> tuple:
+    if not 0 <= shard_piece < pieces:
+        raise ValueError(f"[crawling@home] invalid shard piece {shard_piece} of {pieces}")
+    return count * shard_piece // pieces, count * (shard_piece + 1) // pieces
+
+
+# Returns the decompressed offset from which records belong to gzip members starting at or after the compressed
+# offset `offset`, given a member index (see `download.read_members`), or None if no member does.
+def _member_start(members: list, offset: int) -> Optional[int]:
+    i = bisect_left([compressed for _, compressed in members], offset)
+    return members[i][0] if i < len(members) else None
+
+
+# Returns the [first, last) decompressed offsets of the records belonging to `shard_piece` of the WAT at `path`.
+def _piece_span(path: str, size: int, shard_piece: int, pieces: int) -> tuple:
+    index = read_members(path)
+    if index is None:
+        # decompressed elsewhere, so the compressed offsets are unknown: split the decompressed bytes instead
+        return piece_bounds(size, shard_piece, pieces)
+
+    lo, hi = piece_bounds(index["size"], shard_piece, pieces)
+    first = _member_start(index["members"], lo)
+    return (size if first is None else first), _member_start(index["members"], hi)
+
+
+# Iterates over the records of the decompressed WAT at `path` by memory-mapping it, so no record is copied
+# and memory use stays flat regardless of the file's size.
+# If `shard_piece` is given, only that piece's records are yielded. Shards are split by compressed offset, as in
+# `iter_gzip_records`: a record belongs to the piece its gzip member starts in, out of the download's compressed
+# bytes split into `pieces` (0 = first half and 1 = second half by default). The compressed offsets come from the
+# member index written next to the WAT by `download.fetch_shard` (`shard.wat.members`); WATs without one are split
+# by decompressed offset instead.
+def iter_records(path: str = "shard.wat", shard_piece: int = None, pieces: int = 2) -> Iterator[WatRecord]:
+    with open(path, "rb") as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return  # empty file
+
+    view = memoryview(mm)
+    try:
+        first, last = 0, None
+        if shard_piece is not None:
+            first, last = _piece_span(path, len(mm), shard_piece, pieces)
+
+        for start, headers, body, end in _offsets(mm):
+            if start < first:
+                continue
+            if last is not None and start >= last:
+                break
+            yield WatRecord(headers, view[body:end], start)
+    finally:
+        view.release()
+        try:
+            mm.close()
+        except BufferError:
+            pass  # payloads are still referenced by the caller; the map is freed along with them
+
+
+def _offsets(mm) -> Iterator[tuple]:
+    pos = _next_record(mm, 0)
+    while pos != -1:
+        parsed = _parse_header(mm, pos)
+        if parsed is None:
+            return  # truncated trailing record
+        headers, body, end = parsed
+        yield pos, headers, body, end
+        pos = _next_record(mm, end)
+
+
+# Iterates over the records of a gzipped WAT as it is decompressed from `chunks` (an iterable of compressed bytes),
+# without writing the WAT to disk.
+# `shard_piece` splits by compressed offset, as in `iter_records`: a record belongs to the piece its gzip member
+# starts in, out of `size` compressed bytes split into `pieces`.
+def iter_gzip_records(chunks, shard_piece: int = None, size: int = None, pieces: int = 2) -> Iterator[WatRecord]:
+    lo, hi = 0, None
+    if shard_piece is not None:
+        if not size:
+            raise ValueError("[crawling@home] the compressed size is required to split a stream by shard piece")
+        lo, hi = piece_bounds(size, shard_piece, pieces)
+
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    buf = bytearray()
+    buf_base = 0        # decompressed offset of buf[0]
+    out = 0             # decompressed bytes produced so far
+    consumed = 0        # compressed bytes fed to finished members and the current one
+    marks = deque([(0, 0)])  # (decompressed offset, compressed offset) where each member starts
+    pos = 0
+
+    def records():
+        nonlocal pos, buf, buf_base
+        while True:
+            start = _next_record(buf, pos)
+            if start == -1:
+                pos = max(pos, len(buf) - len(_WARC))
+                break
+            parsed = _parse_header(buf, start)
+            if parsed is None:
+                pos = start
+                break
+            headers, body, end = parsed
+
+            absolute = buf_base + start
+            while len(marks) > 1 and marks[1][0] <= absolute:
+                marks.popleft()
+            member = marks[0][1]
+
+            pos = end
+            if member >= lo and (hi is None or member < hi):
+                yield WatRecord(headers, bytes(buf[body:end]), absolute)
+
+        # drop everything before the next unparsed record
+        if pos:
+            del buf[:pos]
+            buf_base += pos
+            pos = 0
+
+    for chunk in chunks:
+        while chunk:
+            data = d.decompress(chunk)
+            buf += data
+            out += len(data)
+            if not d.eof:
+                consumed += len(chunk)
+                break
+
+            # a member ended: start the next one where the unused input begins
+            used = len(chunk) - len(d.unused_data)
+            consumed += used
+            chunk = d.unused_data
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            marks.append((out, consumed))
+
+        if hi is not None and marks[0][1] >= hi:
+            return
+        yield from records()
+
+    buf += d.flush()
+    yield from records()
+
+
+# Streams the gzipped WAT at `url` through `s` (a requests session) and yields its records as they arrive.
+def iter_url_records(s, url: str, shard_piece: int = None, pieces: int = 2, chunk_size: int = None) -> Iterator[WatRecord]:
+    with s.get(url, stream=True) as r:
+        r.raise_for_status()
+        size = int(r.headers.get("Content-Length", 0)) or None
+        yield from iter_gzip_records(r.iter_content(chunk_size=chunk_size or CHUNK_SIZE), shard_piece, size, pieces)
@@ -0,0 +1,181 @@
+from threading import Thread, Event, Lock
+from queue import Queue, Full
+from time import sleep, monotonic
+
+from .errors import ZeroJobError
+from .retry import RetryPolicy
+from .core import _safe_request, _handle_exceptions
+
+# Delays between lookups while no candidate WAT qualifies, growing with consecutive rejections (with jitter).
+BACKOFF = RetryPolicy(base_delay=0.5, max_delay=30.0)
+
+# Seconds a rejected WAT is skipped for without asking the tracker to verify it again.
+NEGATIVE_TTL = 600.0
+
+# Seconds a prefetched WAT's verification is trusted for; older ones are verified again before being handed out.
+FRESH_TTL = 30.0
+
+
+# Finds WATs for `TempCPUWorker`: asks the tracker for a candidate (`custom/get-cpu-wat`) and verifies it has at
+# least `min_shards` open shards (`custom/lookup-wat`).
+# * WATs that fail verification are remembered for `negative_ttl` seconds and skipped without another lookup.
+# * Consecutive rejections back off under `backoff`, so a contended tracker isn't asked in a tight loop.
+# * `start()` verifies candidates on `workers` background (daemon) threads, keeping up to `depth` verified WATs
+#   queued for the next `next()`. WATs queued for longer than `fresh_ttl` seconds are verified again first.
+class WatLookup:
+    def __init__(self, worker, min_shards: int = 2, negative_ttl: float = NEGATIVE_TTL,
+                 backoff: RetryPolicy = BACKOFF, fresh_ttl: float = FRESH_TTL) -> None:
+        self.worker = worker
+        self.min_shards = min_shards
+        self.negative_ttl = negative_ttl
+        self.backoff = backoff
+        self.fresh_ttl = fresh_ttl
+
+        self.lookups = 0
+        self.rejected = 0
+        self.skipped = 0
+
+        self._lock = Lock()
+        self._negative = {}   # wat -> expiry
+        self._queued = set()
+        self._streak = 0
+        self._ready = None
+        self._stop = Event()
+        self._threads = []
+
+    # Returns the next verified (wat, shards), waiting for one to qualify. Raises `ZeroJobError` when the tracker
+    # has no WATs left (unless prefetching, which waits for new ones instead).
+    def next(self) -> tuple:
+        if self._ready is None:
+            while True:
+                found = self._candidate()
+                if found is not None:
+                    self._release(found[0])
+                    return found
+                sleep(self._delay())
+
+        while True:
+            item = self._ready.get()
+            if isinstance(item, Exception):
+                raise item
+
+            wat, shards, verified = item
+            try:
+                if monotonic() - verified > self.fresh_ttl:
+                    shards = self._verify(wat, monotonic())
+            finally:
+                self._release(wat)
+            if shards is not None:
+                return wat, shards
+
+    def _release(self, wat: str) -> None:
+        with self._lock:
+            self._queued.discard(wat)
+
+    def _request(self, method: str, endpoint: str, **kwargs):
+        r = _safe_request(getattr(self.worker.s, method), self.worker.url + endpoint, **kwargs)
+        exc = _handle_exceptions(r.status_code, r.text)
+        if exc:
+            raise exc
+        return r
+
+    # Fetches and verifies one candidate, returning (wat, shards), or None if it doesn't qualify.
+    def _candidate(self):
+        wat = self._request("get", "custom/get-cpu-wat").text.strip()
+        if "http" not in wat:
+            raise ZeroJobError(f"[crawling@home] no WATs available ({wat[:100]})")
+
+        now = monotonic()
+        with self._lock:
+            expiry = self._negative.get(wat)
+            if expiry is not None and expiry <= now:
+                del self._negative[wat]
+                expiry = None
+            if expiry is not None or wat in self._queued:
+                self.skipped += 1
+                return None
+            self._queued.add(wat)  # verified or queued by another thread until released
+
+        try:
+            shards = self._verify(wat, now)
+        except BaseException:
+            self._release(wat)
+            raise
+        if shards is None:
+            self._release(wat)
+            return None
+        return wat, shards
+
+    # Looks `wat` up, returning its shards, or None (negatively caching it) if it doesn't qualify.
+    def _verify(self, wat: str, now: float):
+        with self._lock:
+            self.lookups += 1
+        try:
+            data = self._request("post", "custom/lookup-wat", json={"url": wat}).json()
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            data = {}
+        shards = data.get("shards")
+
+        with self._lock:
+            if data.get("status") != "success" or not shards or len(shards) < self.min_shards:
+                self.rejected += 1
+                self._negative[wat] = now + self.negative_ttl
+                if len(self._negative) > 10_000:
+                    self._negative = {k: v for k, v in self._negative.items() if v > now}
+                return None
+            self._streak = 0
+        return shards
+
+    def _delay(self) -> float:
+        with self._lock:
+            self._streak = min(self._streak + 1, 32)
+            return self.backoff.delay(self._streak)
+
+    # Starts verifying candidates on `workers` background threads, keeping up to `depth` verified WATs queued.
+    def start(self, depth: int = 1, workers: int = 4) -> None:
+        if self._threads:
+            return
+        self._ready = Queue(maxsize=max(1, depth))
+        for i in range(workers):
+            thread = Thread(target=self._run, name=f"cah-watlookup-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                item = self._candidate()
+            except ZeroJobError:
+                item = None  # wait for WATs to become available
+            except Exception as e:
+                item = e  # surfaced by the next `next()`
+
+            if isinstance(item, tuple):
+                item = (*item, monotonic())
+            if item is not None:
+                self._put(item)
+            if item is None or isinstance(item, Exception):
+                self._stop.wait(self._delay())
+
+    def _put(self, item) -> None:
+        while not self._stop.is_set():
+            try:
+                self._ready.put(item, timeout=1)
+                return
+            except Full:
+                continue
+
+    # Stops the background threads. Verified WATs still queued are dropped.
+    def stop(self) -> None:
+        if not self._threads:
+            return
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._ready = None
+        self._stop.clear()
+        with self._lock:
+            self._queued.clear()